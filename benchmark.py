@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''benchmarks the SoFS engine in-process, calling the SoFS operations without a kernel mount.
+Prints a JSON report with ops/sec and latency percentiles for each phase:
+    ./benchmark.py --files 100 --file-size 65536 --io-size 4096 > results.json'''
+import os
+import sys
+import json
+import time
+import random
+import optparse
+import tempfile
+import sofs
+
+PERCENTILES= (50, 90, 99)
+
+class Benchmark:
+    def __init__(self, options):
+        self.options= options
+        self.image= options.image
+        if not self.image:
+            fd, self.image= tempfile.mkstemp(prefix="sofs-bench-", suffix=".img")
+            os.close(fd)    #mkfs replaces it
+        self.random= random.Random(options.seed)
+        self.results= []
+        self.fs= None
+        self.memory= None   #the MemoryDevice of the ram backend, kept across remounts
+
+    def device(self):
+        o= self.options
+        if o.backend=="mmap":
+            return self.image
+        device= self.memory if o.backend=="ram" else sofs.FileDevice(self.image)
+        if o.latency:
+            device= sofs.LatencyDevice( device, o.latency/1e6, o.latency/1e6 )
+        return device
+
+    def mount(self):
+        fs= sofs.SoFS()
+        fs.device= self.image
+        fs.format= sofs.SofsFormat( self.device(), cache_blocks=self.options.cache, use_mmap= self.options.backend=="mmap",
+                                    journal=self.options.journal )
+        self.fs= fs
+
+    def remount(self):
+        '''unmounts and mounts again, so reads start with an empty block cache'''
+        self.fs.fsdestroy()
+        self.mount()
+
+    def path(self, i):
+        return "/bench/f{0}".format(i)
+
+    def phase(self, name, calls, nbytes=0):
+        '''runs the calls, timing each one, and records the results of the phase'''
+        sofs.stats.reset()
+        latencies= []
+        start= time.time()
+        for call in calls:
+            t= time.time()
+            call()
+            latencies.append( time.time()-t )
+        elapsed= time.time()-start
+        latencies.sort()
+        n= len(latencies)
+        result= {
+            "phase": name,
+            "ops": n,
+            "seconds": elapsed,
+            "ops_per_sec": n/elapsed if elapsed else None,
+            #a phase with no calls, as with --files 0, has no latencies
+            "latency_us": dict( ("p{0}".format(p), latencies[ min(n-1, n*p/100) ]*1e6 if n else None) for p in PERCENTILES ),
+            "counters": dict(sofs.stats.counters),
+            }
+        result["latency_us"]["max"]= latencies[-1]*1e6 if latencies else None
+        if nbytes:
+            result["mb_per_sec"]= nbytes/elapsed/2**20 if elapsed else None
+        self.results.append(result)
+        sys.stderr.write( "{0:12} {1:8} ops {2:10.0f} ops/s  p50 {3:8.1f}us  p99 {4:8.1f}us\n".format(
+            name, result["ops"], result["ops_per_sec"] or 0, result["latency_us"]["p50"] or 0, result["latency_us"]["p99"] or 0 ) )
+
+    def run(self):
+        o= self.options
+        blocks= o.files*(o.file_size/o.block_size + 4)*2 + 4096    #data, tables and metadata, with room to spare
+        if o.backend=="ram":
+            self.memory= sofs.MemoryDevice( bytearray(blocks*o.block_size) )
+            sofs.mkfs( self.memory, blocks, o.block_size, o.journal )
+        else:
+            sofs.mkfs( self.image, blocks, o.block_size, o.journal )
+        self.mount()
+        self.fs.mkdir("/bench", 0755)
+        files= range(o.files)
+        chunks= range(0, o.file_size, o.io_size)
+        data= os.urandom(o.io_size)
+        size= lambda off: min(o.io_size, o.file_size-off)    #the last chunk ends at file_size
+        handles= {}
+        def create(i):
+            handles[i]= self.fs.file_class( self.path(i), os.O_CREAT | os.O_RDWR, 0644 )
+        self.phase( "create", [lambda i=i: create(i) for i in files] )
+        self.phase( "seq_write", [lambda i=i, off=off: handles[i].write(data[:size(off)], off) for i in files for off in chunks],
+                    o.files*o.file_size )
+        self.remount()
+        handles= dict( (i, self.fs.file_class(self.path(i), os.O_RDWR)) for i in files )
+        self.phase( "seq_read", [lambda i=i, off=off: handles[i].read(size(off), off) for i in files for off in chunks],
+                    o.files*o.file_size )
+        ops= [(self.random.choice(files), self.random.choice(chunks)) for _ in xrange(o.files*len(chunks))]
+        self.phase( "rand_write", [lambda i=i, off=off: handles[i].write(data[:size(off)], off) for i, off in ops],
+                    sum( size(off) for _, off in ops ) )
+        self.remount()
+        handles= dict( (i, self.fs.file_class(self.path(i), os.O_RDWR)) for i in files )
+        self.phase( "rand_read", [lambda i=i, off=off: handles[i].read(size(off), off) for i, off in ops],
+                    sum( size(off) for _, off in ops ) )
+        order= list(files)
+        self.random.shuffle(order)
+        self.phase( "stat", [lambda i=i: self.fs.getattr(self.path(i)) for i in order] )
+        self.phase( "statfs", [self.fs.statfs for i in order] )
+        self.phase( "truncate", [lambda i=i: self.fs.truncate(self.path(i), o.file_size/2) for i in order] )
+        self.phase( "unlink", [lambda i=i: self.fs.unlink(self.path(i)) for i in order] )
+        self.fs.fsdestroy()
+        if not o.image:
+            os.remove(self.image)
+        return {"config": vars(o), "results": self.results}
+
+if __name__ == '__main__':
+    parser= optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--files", type="int", default=100, help="number of files (default 100)")
+    parser.add_option("--file-size", type="int", default=64*1024, help="bytes per file (default 65536)")
+    parser.add_option("--io-size", type="int", default=4096, help="bytes per read or write (default 4096)")
+    parser.add_option("--block-size", type="int", default=sofs.SofsFormat.DEFAULT_BLOCK_SIZE, help="FS block size (default %default)")
+    parser.add_option("--cache", type="int", default=sofs.SofsFormat.CACHE_BLOCKS, help="blocks in the block cache")
+    parser.add_option("--backend", default="file", help="device access: file (default), mmap or ram")
+    parser.add_option("--latency", type="float", default=0, help="microseconds added to each device read and write (not with mmap)")
+    parser.add_option("--no-journal", dest="journal", action="store_false", default=True, help="don't log metadata")
+    parser.add_option("--image", help="image file to use, replaced if it exists (default: a temporary file)")
+    parser.add_option("--seed", type="int", default=0, help="seed of the random offsets")
+    parser.add_option("-o", "--output", help="write the JSON report to this file instead of stdout")
+    options, args= parser.parse_args()
+    report= Benchmark(options).run()
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump( report, f, indent=1, sort_keys=True )
+    else:
+        json.dump( report, sys.stdout, indent=1, sort_keys=True )
+        sys.stdout.write("\n")
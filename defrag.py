@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+'''defragments an unmounted SoFS image, moving the data blocks of each file to a contiguous run,
+and prints fragmentation statistics before and after as JSON:
+    ./defrag.py IMAGE
+A mounted FS can be defragmented in the background with the defrag=SECONDS mount option'''
+import sys
+import json
+import optparse
+import sofs
+
+if __name__ == '__main__':
+    parser= optparse.OptionParser(usage="%prog IMAGE")
+    parser.add_option("-n", "--dry-run", action="store_true", default=False, help="only print the fragmentation statistics")
+    options, args= parser.parse_args()
+    if len(args)!=1:
+        parser.error("an image is required")
+    fs= sofs.SofsFormat( args[0] )
+    try:
+        report= fs.defragment( move=not options.dry_run )
+    finally:
+        fs.close()
+    json.dump( report, sys.stdout, indent=1, sort_keys=True )
+    sys.stdout.write("\n")
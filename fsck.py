@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+'''checks, and optionally repairs, an unmounted SoFS image without mounting it:
+    ./fsck.py [-y] IMAGE
+The image is read in large sequential chunks, and the structure is walked in passes of
+increasing block number. Every block reached from block 0 (the InfoBlock, bitmap, journal,
+inodes, pointer blocks, directory buckets and data blocks) is marked in an in-memory bitmap,
+which is then compared with the on-disk bitmap, or the free list of legacy images.
+Exit status as e2fsck: 0 no problems, 1 problems fixed, 4 problems left, 8 operational error'''
+import sys
+import re
+import errno
+import json
+import time
+import heapq
+import functools
+import collections
+import optparse
+import sofs
+from sofs import _intStruct, IntTable, ZeroBlock, INodeBlock, DirectoryINode, InfoBlock, FreeBitmap, Journal, SofsFormat
+
+DEFAULT= IntTable.DEFAULT_VALUE
+INT= SofsFormat.INT_SIZE
+_INVERT= "".join( chr(255-i) for i in range(256) )
+
+class Directory:
+    '''what the walk learned about a directory'''
+    def __init__(self, index, path, entries):
+        self.index, self.path= index, path
+        self.entries= entries   #the count recorded on the inode
+        self.found= 0           #entries seen in the buckets
+        self.dropped= 0         #entries removed by repairs
+
+class Checker:
+    CHUNK= 1<<20    #bytes read from the device at a time
+    EXAMPLES= 10    #block numbers listed in a message
+    def __init__(self, filename_or_device, repair=False):
+        self.device= sofs.FileDevice(filename_or_device) if isinstance(filename_or_device, basestring) else filename_or_device
+        self.repair= repair
+        self.chunk_start, self.chunk= 0, ""
+        self.next_index= None   #the block read after the current one, if known
+        self.overlay= {}        #block index -> image, of a committed journal transaction that mounting would replay
+        self.replayed= 0        #blocks of that transaction
+        self.problems= []
+        self.counts= collections.Counter()  #problems by kind
+        self.fixes= []          #repairs, run after the walk in the order they were found
+        self.pending, self.next_pending= [], []     #blocks to visit in this pass and in the next one
+        self.position, self.sequence= -2**31, 0
+        self.tables= []         #(block, int offset, count, first file block, path) of every file data table
+        self.directories= []
+        self.files= 0
+
+    def _read(self, index):
+        '''returns the contents of a block. Reads CHUNK bytes at a time when the next block
+        to read is close enough to be in them'''
+        image= self.overlay.get(index)
+        if image is not None:
+            return image
+        offset= index*self.bs - self.chunk_start
+        if not 0 <= offset <= len(self.chunk)-self.bs:
+            self.chunk_start= index*self.bs
+            near= self.next_index is not None and 0 <= (self.next_index-index)*self.bs < self.CHUNK
+            self.chunk= self.device.pread( max(self.CHUNK, self.bs) if near else self.bs, self.chunk_start )
+            if len(self.chunk) < self.bs:
+                self.chunk+= "\0"*(self.bs - len(self.chunk))  #past the end of the image
+            offset= 0
+        return self.chunk[offset:offset+self.bs]
+
+    def _write(self, offset, data):
+        self.device.pwrite(data, offset)
+        self.chunk= ""
+
+    def _writeInts(self, index, int_offset, ints):
+        self._write( index*self.bs + int_offset*INT, _intStruct(len(ints)).pack(*ints) )
+
+    def problem(self, kind, message, fix=None):
+        self.counts[kind]+= 1
+        self.problems.append(message)
+        if fix is not None:
+            self.fixes.append(fix)
+
+    def _examples(self, indexes):
+        shown= ", ".join( map(str, indexes[:self.EXAMPLES]) )
+        return shown + (", ..." if len(indexes) > self.EXAMPLES else "")
+
+    def _inFS(self, index):
+        return 0 < index < self.block_count
+
+    def _claim(self, index):
+        '''marks a block used. Returns False if it already was'''
+        bit= 1<<(index&7)
+        if self.used[index>>3] & bit:
+            return False
+        self.used[index>>3]|= bit
+        return True
+
+    def _allocate(self):
+        '''returns a block that is not used, marking it used, or None if the FS is full'''
+        m= FreeBitmap.NOT_FULL.search(self.used)
+        while m is not None:
+            for index in xrange(m.start()*8, min(m.start()*8+8, self.block_count)):
+                if self._claim(index):
+                    return index
+            m= FreeBitmap.NOT_FULL.search(self.used, m.start()+1)
+        return None
+
+    def _schedule(self, index, visit, *args):
+        '''queues a block visit. Blocks are visited in increasing order, in as many passes as needed'''
+        queue= self.pending if index >= self.position else self.next_pending
+        heapq.heappush( queue, (index, self.sequence, visit, args) )
+        self.sequence+= 1
+
+    def _walk(self):
+        while self.pending or self.next_pending:
+            if not self.pending:
+                self.pending, self.next_pending= self.next_pending, []
+                self.position= -2**31
+            index, _, visit, args= heapq.heappop(self.pending)
+            self.position= index
+            self.next_index= self.pending[0][0] if self.pending else None
+            visit(index, *args)
+
+    def _readSuper(self):
+        header= self.device.pread( 5*INT, 0 )
+        magic_1, magic_2, self.bs, self.block_count, info= _intStruct(5).unpack( header ) if len(header)==5*INT else (0,)*5
+        if magic_1!=ZeroBlock.MAGIC_1 or magic_2 not in (ZeroBlock.MAGIC_2, ZeroBlock.MAGIC_2_BITMAP) or \
+                self.bs not in SofsFormat.BLOCK_SIZES or self.block_count < 2:
+            e= IOError("Bad FS magic number")
+            e.errno= errno.EINVAL
+            raise e
+        self.legacy= magic_2==ZeroBlock.MAGIC_2
+        self.ints= self.bs/INT
+        #the inode layout, see INodeBlock
+        self.table_size= self.ints - INodeBlock.DATA_TABLE_START - INodeBlock.TAIL_INTS
+        self.indirect_offset= self.ints - INodeBlock.TAIL_INTS
+        self.max_blocks= self.table_size + self.ints + self.ints**2
+        self.max_size= min( self.bs*self.max_blocks, 2**31-1 )
+        self.entries_per_block= (self.bs - INT) / DirectoryINode.ENTRY.size
+        nbitmap= FreeBitmap.blocksNeeded( self.block_count, self.bs )
+        self.used= bytearray( nbitmap*self.bs )
+        for i in xrange( self.block_count, len(self.used)*8 ):
+            self.used[i>>3]|= 1<<(i&7)  #bits past the last block are set, as mkfs does
+        self._claim(0)
+        self.features, self.root= 0, DEFAULT
+        if self.legacy:
+            self.free_list_head= info
+            return
+        if not self._inFS(info):
+            raise IOError("Bad InfoBlock index {0}".format(info))
+        self.info= info
+        for replayed in (False, True):
+            magic, self.features, self.bitmap_start, self.bitmap_blocks, journal_start, journal_blocks, self.root, \
+                self.free_blocks, self.inode_count= _intStruct(9).unpack_from( self._read(info) )
+            if magic!=InfoBlock.MAGIC or self.bitmap_blocks!=nbitmap or not self._inFS(self.bitmap_start):
+                raise IOError("Bad InfoBlock at block {0}".format(info))
+            if replayed or not self.features & InfoBlock.FEATURE_JOURNAL or not self._readJournal(journal_start, journal_blocks):
+                break   #else read the InfoBlock again, as the transaction may change it
+        regions= [(info, 1), (self.bitmap_start, nbitmap)]
+        if self.features & InfoBlock.FEATURE_JOURNAL:
+            regions.append( (journal_start, journal_blocks) )
+        for start, n in regions:
+            overlapping= [i for i in xrange(start, start+n) if not self._inFS(i) or not self._claim(i)]
+            if overlapping:
+                self.problem( "double", "the FS regions overlap or are out of the FS at blocks {0}".format(self._examples(overlapping)) )
+
+    def _readJournal(self, start, nblocks):
+        '''loads the committed transaction that mounting would replay, or replays it when repairing,
+        so the walk sees the metadata that the FS will use. Returns True if there was one'''
+        transaction= Journal.readLog( self.device, start, nblocks, self.bs )
+        if transaction is None:
+            return False
+        blocks, images= transaction
+        self.replayed= len(blocks)
+        if self.repair:
+            for i, block in enumerate(blocks):
+                self._write( block*self.bs, images[i*self.bs:(i+1)*self.bs] )
+            self._write( start*self.bs, "\0"*self.bs )
+            self.device.sync()
+        else:
+            for i, block in enumerate(blocks):
+                self.overlay[block]= images[i*self.bs:(i+1)*self.bs]
+        return True
+
+    def _visitInode(self, index, path, where, cut, parent):
+        '''checks an inode and queues its tables. cut removes the reference to it'''
+        def bad(message):
+            self.problem( "bad_inode", "{0}: {1}".format(where, message), cut )
+            if parent is not None:
+                parent.dropped+= 1
+        if not self._inFS(index):
+            return bad("inode block {0} is out of the FS".format(index))
+        raw= self._read(index)
+        if INodeBlock.HEADER.unpack_from(raw)[0]!=INodeBlock.MAGIC:
+            return bad("block {0} is not an inode".format(index))
+        if not self._claim(index):
+            return bad("inode block {0} is already in use".format(index))
+        magic, name, size= INodeBlock.HEADER.unpack_from(raw)
+        path= path or "/"+name.split("\0")[0]
+        indirect= double= kind= entries= inline= reserved= fallocated= DEFAULT
+        if self.features & InfoBlock.FEATURE_INDIRECT:   #else the inode tails are uninitialized
+            indirect, double, kind, entries, inline, reserved, fallocated= _intStruct(7).unpack_from( raw, self.indirect_offset*INT )
+        inline= inline==INodeBlock.INLINE_FILE and kind!=INodeBlock.TYPE_DIR
+        max_size= self.table_size*INT if inline else self.max_size
+        if not 0 <= size <= max_size:
+            fixed= min( max(size, 0), max_size )
+            self.problem( "bad_size", "{0}: bad size {1}".format(path, size), functools.partial(self._writeInts, index, 17, (fixed,)) )
+            size= fixed
+        directory= None
+        if kind==INodeBlock.TYPE_DIR:
+            directory= Directory(index, path, entries)
+            self.directories.append(directory)
+        else:
+            self.files+= 1
+        if inline:
+            return  #the data table holds the file bytes
+        n_blocks= ((size-1) / self.bs)+1
+        if reserved!=DEFAULT:   #blocks reserved past the end of the file, see INodeBlock.RESERVED
+            if n_blocks < reserved <= self.max_blocks:
+                n_blocks= reserved
+            else:
+                self.problem( "bad_size", "{0}: bad reserved block count {1}".format(path, reserved),
+                              functools.partial(self._writeInts, index, self.indirect_offset+5, (DEFAULT, DEFAULT)) )
+                fallocated= DEFAULT
+        if fallocated!=DEFAULT and not ((size-1) / self.bs)+1 < fallocated <= n_blocks:    #see INodeBlock.FALLOCATED
+            self.problem( "bad_size", "{0}: bad preallocated block count {1}".format(path, fallocated),
+                          functools.partial(self._writeInts, index, self.indirect_offset+6, (DEFAULT,)) )
+        self._dataTable( index, INodeBlock.DATA_TABLE_START, min(n_blocks, self.table_size), 0, path, directory, raw )
+        first= self.table_size
+        for pointer, offset, visit in ((indirect, self.indirect_offset, self._visitIndirect), (double, self.indirect_offset+1, self._visitDouble)):
+            if pointer!=DEFAULT:
+                cut= functools.partial(self._writeInts, index, offset, (DEFAULT,))
+                self._schedule( pointer, visit, path, directory, n_blocks, first, cut )
+            first+= self.ints
+
+    def _pointerBlock(self, index, path, cut):
+        '''checks that a pointer block can be claimed, and returns its ints'''
+        if not self._inFS(index):
+            self.problem( "bad_pointer", "{0}: pointer block {1} is out of the FS".format(path, index), cut )
+        elif not self._claim(index):
+            self.problem( "double", "{0}: pointer block {1} is already in use".format(path, index), cut )
+        else:
+            return _intStruct(self.ints).unpack( self._read(index) )
+
+    def _visitIndirect(self, index, path, directory, n_blocks, first, cut):
+        if self._pointerBlock(index, path, cut) is not None:
+            self._dataTable( index, 0, max( min(self.ints, n_blocks-first), 0 ), first, path, directory )
+
+    def _visitDouble(self, index, path, directory, n_blocks, first, cut):
+        pointers= self._pointerBlock(index, path, cut)
+        for k, pointer in enumerate(pointers or ()):
+            if pointer!=DEFAULT:
+                cut= functools.partial(self._writeInts, index, k, (DEFAULT,))
+                self._schedule( pointer, self._visitIndirect, path, directory, n_blocks, first + k*self.ints, cut )
+
+    def _dataTable(self, index, offset, count, first, path, directory, raw=None):
+        '''records the data pointers of a file, or queues the buckets of a directory'''
+        if count <= 0:
+            return
+        if directory is None:
+            self.tables.append( (index, offset, count, first, path) )  #claimed after the walk
+            return
+        raw= raw or self._read(index)
+        for slot, pointer in enumerate( _intStruct(count).unpack_from(raw, offset*INT) ):
+            fix= functools.partial(self._newBucket, index, offset+slot)
+            where= "{0}: bucket {1}".format(directory.path, first+slot)
+            if pointer==DEFAULT:
+                self.problem( "bad_pointer", where+" is missing", fix )
+            else:
+                self._schedule( pointer, self._visitBucket, directory, where, fix )
+
+    def _newBucket(self, index, int_offset):
+        '''points a directory bucket pointer to a new empty bucket'''
+        bucket= self._allocate()
+        if bucket is not None:
+            self._write( bucket*self.bs, "\xff"*self.bs )
+            self._writeInts( index, int_offset, (bucket,) )
+
+    def _visitBucket(self, index, directory, where, fix):
+        '''checks a directory bucket block, or overflow block, and queues its entries'''
+        if not self._inFS(index):
+            return self.problem( "bad_pointer", "{0}: block {1} is out of the FS".format(where, index), fix )
+        if not self._claim(index):
+            return self.problem( "double", "{0}: block {1} is already in use".format(where, index), fix )
+        raw= self._read(index)
+        for slot in xrange(self.entries_per_block):
+            offset= INT + slot*DirectoryINode.ENTRY.size
+            inode, name= DirectoryINode.ENTRY.unpack_from( raw, offset )
+            if inode!=DEFAULT:
+                directory.found+= 1
+                name= name.split("\0")[0]
+                path= directory.path.rstrip("/") + "/" + name
+                cut= functools.partial( self._write, index*self.bs + offset, DirectoryINode.ENTRY.pack(DEFAULT, "") )
+                self._schedule( inode, self._visitInode, path, path, cut, directory )
+        next_index= _intStruct(1).unpack_from( raw, DirectoryINode.NEXT*INT )[0]
+        if next_index!=DEFAULT:
+            cut= functools.partial(self._writeInts, index, DirectoryINode.NEXT, (DEFAULT,))
+            self._schedule( next_index, self._visitBucket, directory, where+" overflow", cut )
+
+    def _claimData(self):
+        '''claims the data blocks of the files, after the metadata, so a data pointer to a metadata
+        block is the one found to be wrong'''
+        tables= sorted(self.tables)
+        for i, (index, offset, count, first, path) in enumerate(tables):
+            self.next_index= tables[i+1][0] if i+1 < len(tables) else None
+            for slot, pointer in enumerate( _intStruct(count).unpack_from( self._read(index), offset*INT ) ):
+                if pointer==DEFAULT:
+                    continue
+                if not self._inFS(pointer):
+                    self.problem( "bad_pointer", "{0}: block {1} is out of the FS".format(path, pointer),
+                                  functools.partial(self._writeInts, index, offset+slot, (DEFAULT,)) )
+                elif not self._claim(pointer):
+                    self.problem( "double", "{0}: data block {1} (file block {2}) is already in use".format(path, pointer, first+slot),
+                                  functools.partial(self._copyBlock, pointer, index, offset+slot) )
+
+    def _copyBlock(self, pointer, index, int_offset):
+        '''gives a file its own copy of a block it shares, or a hole if the FS is full'''
+        copy= self._allocate()
+        if copy is not None:
+            self._write( copy*self.bs, self._read(pointer) )
+        self._writeInts( index, int_offset, (DEFAULT if copy is None else copy,) )
+
+    def _checkDirectories(self):
+        for d in self.directories:
+            count= d.found - d.dropped
+            if d.entries!=d.found:
+                self.problem( "entry_count", "{0}: {1} entries recorded, {2} found".format(d.path, d.entries, d.found) )
+            if count!=d.entries:
+                self.fixes.append( functools.partial(self._writeInts, d.index, self.indirect_offset+3, (count,)) )   #DirectoryINode.ENTRY_COUNT
+
+    def _blocks(self, bits):
+        '''returns the indexes of the set bits of a bitmap, from block 1 to the last FS block'''
+        found= []
+        for m in re.finditer('[^\0]', str(bits)):
+            for index in xrange(max(m.start()*8, 1), min(m.start()*8+8, self.block_count)):
+                if bits[index>>3] & (1<<(index&7)):
+                    found.append(index)
+        return found
+
+    def _checkBitmap(self):
+        on_disk= bytearray( "".join( self._read(i) for i in xrange(self.bitmap_start, self.bitmap_start+self.bitmap_blocks) ) )
+        if on_disk==self.used:
+            return
+        lost= bytearray( u & ~d & 0xff for u, d in zip(self.used, on_disk) )
+        leaked= bytearray( d & ~u & 0xff for u, d in zip(self.used, on_disk) )
+        lost, leaked= self._blocks(lost), self._blocks(leaked)
+        if lost:
+            self.problem( "lost", "{0} blocks in use are marked free: {1}".format(len(lost), self._examples(lost)) )
+        if leaked:
+            self.problem( "leaked", "{0} blocks marked used are not in use: {1}".format(len(leaked), self._examples(leaked)) )
+
+    def _free(self):
+        '''returns the number of blocks that are not in use'''
+        used= sum( self.used[:self.block_count>>3].translate(sofs._POPCOUNT) )
+        used+= sum( 1 for i in xrange(self.block_count & ~7, self.block_count) if self.used[i>>3] & (1<<(i&7)) )
+        return self.block_count - used
+
+    def _checkCounters(self):
+        '''checks the free block and inode counts of the InfoBlock, which statfs reports'''
+        free, inodes= self._free(), self.files + len(self.directories)
+        if (self.free_blocks, self.inode_count)!=(free, inodes):
+            self.problem( "counters", "the InfoBlock counts {0} free blocks and {1} inodes, found {2} and {3}".format(
+                self.free_blocks, self.inode_count, free, inodes ) )
+        if self.problems:   #counted after the other repairs, which may allocate blocks
+            self.fixes.append( lambda: self._writeInts( self.info, InfoBlock.FREE_BLOCKS, (self._free(), inodes) ) )
+
+    def _checkFreeList(self):
+        '''checks the legacy free list, a chain of blocks from block 0'''
+        listed= bytearray( len(self.used) )
+        prev, index= 0, self.free_list_head
+        while index!=DEFAULT:
+            if not self._inFS(index):
+                self.problem( "free_list", "the free list points out of the FS, at block {0}".format(prev) )
+                break
+            if listed[index>>3] & (1<<(index&7)):
+                self.problem( "free_list", "the free list has a cycle, at block {0}".format(index) )
+                break
+            listed[index>>3]|= 1<<(index&7)
+            prev, index= index, _intStruct(1).unpack_from( self._read(index) )[0]
+        free= bytearray( str(self.used).translate(_INVERT) )   #block 0 and the bits past the last block are clear
+        if listed==free:
+            return
+        in_use= self._blocks( bytearray( l & u for l, u in zip(listed, self.used) ) )
+        leaked= self._blocks( bytearray( f & ~l & 0xff for f, l in zip(free, listed) ) )
+        if in_use:
+            self.problem( "double", "{0} blocks in use are in the free list: {1}".format(len(in_use), self._examples(in_use)) )
+        if leaked:
+            self.problem( "leaked", "{0} blocks are neither in use nor in the free list: {1}".format(len(leaked), self._examples(leaked)) )
+
+    def _writeFreeList(self):
+        free= self._blocks( bytearray( str(self.used).translate(_INVERT) ) )
+        for index, next_index in zip( free, free[1:] + [DEFAULT] ):
+            self._writeInts( index, 0, (next_index,) )
+        self._writeInts( 0, 4, (free[0] if free else DEFAULT,) )
+
+    def run(self):
+        '''checks the image, and repairs it if asked to. Returns a report'''
+        start= time.time()
+        self._readSuper()
+        if self.features & InfoBlock.FEATURE_DIRS:
+            self._schedule( self.root, self._visitInode, "/", "root directory", None, None )
+        else:
+            #files are listed on block 0
+            for slot in xrange(ZeroBlock.TABLE_START, self.ints):
+                index= _intStruct(1).unpack_from( self._read(0), slot*INT )[0]
+                if index!=DEFAULT:
+                    cut= functools.partial(self._writeInts, 0, slot, (DEFAULT,))
+                    self._schedule( index, self._visitInode, None, "inode table slot {0}".format(slot), cut, None )
+        self._walk()
+        root_ok= not self.features & InfoBlock.FEATURE_DIRS or \
+            bool(self.directories) and self.directories[0].index==self.root     #the root is visited first
+        if not root_ok:
+            self.problem( "bad_inode", "the root directory is missing, the FS can't be repaired" )
+            self.fixes= []
+        self._claimData()
+        self._checkDirectories()
+        if self.legacy:
+            self._checkFreeList()
+        else:
+            self._checkBitmap()
+        if self.features & InfoBlock.FEATURE_COUNTERS:
+            self._checkCounters()
+        fixed= self.repair and root_ok and bool(self.problems or self.fixes)
+        if fixed:
+            for fix in self.fixes:
+                fix()
+            if self.legacy:
+                self._writeFreeList()
+            else:
+                self._write( self.bitmap_start*self.bs, str(self.used) )
+            self.device.sync()
+        free= self._free()
+        return {
+            "blocks": self.block_count,
+            "block_size": self.bs,
+            "free": free,
+            "files": self.files,
+            "directories": len(self.directories),
+            "journal_replayed": self.replayed,
+            "problems": self.problems,
+            "counts": dict(self.counts),
+            "fixed": fixed,
+            "seconds": time.time()-start,
+            }
+
+if __name__ == '__main__':
+    parser= optparse.OptionParser(usage="%prog [options] IMAGE")
+    parser.add_option("-y", "--repair", action="store_true", default=False, help="repair the problems found. The FS must not be mounted")
+    parser.add_option("-n", "--check", dest="repair", action="store_false", help="only report problems (default)")
+    parser.add_option("--json", action="store_true", default=False, help="print the report as JSON")
+    options, args= parser.parse_args()
+    if len(args)!=1:
+        parser.error("an image is required")
+    try:
+        report= Checker( args[0], repair=options.repair ).run()
+    except (IOError, OSError) as e:
+        sys.stderr.write( "{0}: {1}\n".format(args[0], e) )
+        sys.exit(8)
+    if options.json:
+        json.dump( report, sys.stdout, indent=1, sort_keys=True )
+        sys.stdout.write("\n")
+    else:
+        for message in report["problems"]:
+            sys.stdout.write( message+"\n" )
+        sys.stdout.write( "{0}: {1} files, {2} directories, {3}/{4} blocks free, {5} problems{6} ({7:.2f}s)\n".format(
+            args[0], report["files"], report["directories"], report["free"], report["blocks"], len(report["problems"]),
+            " fixed" if report["fixed"] else "", report["seconds"] ) )
+    if not report["problems"]:
+        sys.exit(0)
+    sys.exit(1 if report["fixed"] else 4)
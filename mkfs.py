@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+'''creates an empty SoFS image. Takes the same options as disk_creator:
+    ./mkfs.py -s NBLOCKS -f FILE [-b BLOCK_SIZE] [--no-journal]'''
+import optparse
+import sofs
+
+if __name__ == '__main__':
+    parser= optparse.OptionParser(usage="%prog -s NBLOCKS -f FILE [options]")
+    parser.add_option("-s", dest="nblocks", type="int", help="number of blocks")
+    parser.add_option("-f", dest="filename", help="image file, replaced if it exists")
+    parser.add_option("-b", dest="block_size", type="int", default=sofs.SofsFormat.DEFAULT_BLOCK_SIZE, help="block size in bytes, a power of two from 512 to 65536 (default %default)")
+    parser.add_option("--no-journal", dest="journal", action="store_false", default=True, help="don't create a metadata journal")
+    options, args= parser.parse_args()
+    if options.nblocks is None or options.filename is None:
+        parser.error("-s and -f are required")
+    sofs.mkfs( options.filename, options.nblocks, options.block_size, options.journal )
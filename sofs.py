@@ -6,6 +6,17 @@ import stat
 import time
 import struct
 import os
+import collections
+import mmap
+import array
+import re
+import threading
+import contextlib
+import functools
+import json
+import signal
+import zlib
+import weakref
 
 import logging
 log= logging.getLogger('sofs')
@@ -13,10 +24,220 @@ formatter = logging.Formatter('%(asctime)s\t%(levelname)s\t%(name)s\t%(module)s\
 hdlr = logging.FileHandler('sofs.log.tsv', mode="w")
 hdlr.setFormatter(formatter)
 log.addHandler(hdlr) 
-log.setLevel(logging.DEBUG)
+log.setLevel(logging.INFO)
+
+DEBUG= False    #per-operation debug logging; guards every log.debug on a hot path
+def setDebugLogging(enabled):
+    global DEBUG
+    DEBUG= enabled
+    log.setLevel(logging.DEBUG if enabled else logging.INFO)
+
+class Stats:
+    '''operation counters and latency histograms, kept off the logging path.
+    Updates are not locked, so on multithreaded mounts the counts are approximate'''
+    BUCKETS= 32     #bucket i counts latencies below 2**i microseconds
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters= collections.defaultdict(int)
+        self.histograms= collections.defaultdict(lambda: [0]*self.BUCKETS)
+
+    def observe(self, name, seconds):
+        '''adds a latency measure to the histogram of name'''
+        self.histograms[name][ min( int(seconds*1e6).bit_length(), self.BUCKETS-1 ) ]+= 1
+
+    def snapshot(self):
+        histograms= {}
+        for name, buckets in self.histograms.items():
+            histograms[name]= dict( ("<{0}us".format(2**i), n) for i, n in enumerate(buckets) if n )
+        return {"counters": dict(self.counters), "latency": histograms}
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump( self.snapshot(), f, indent=1, sort_keys=True )
+
+stats= Stats()
+
+def _timed(name):
+    '''records the latency of every call of the decorated function in stats'''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start= time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stats.observe( name, time.time()-start )
+        return wrapper
+    return decorator
+
+def _operation(f):
+    '''counts the calls of a FUSE operation, and logs them if DEBUG is set'''
+    name= "op."+f.__name__
+    @functools.wraps(f)
+    def wrapper(self, *args):
+        stats.counters[name]+= 1
+        if DEBUG:
+            log.debug("called {0} {1}".format(f.__name__, args))
+        return f(self, *args)
+    return wrapper
 
 fuse.fuse_python_api = (0, 2)
 
+def _view(obj, offset, size):
+    '''returns a zero-copy view of size bytes of obj, starting at offset'''
+    try:
+        return memoryview(obj)[offset:offset+size]
+    except TypeError:   #python 2 mmap objects only support the old buffer interface
+        return buffer(obj, offset, size)
+
+_int_structs= {}
+def _intStruct(n):
+    '''returns a precompiled struct for n little-endian ints'''
+    s= _int_structs.get(n)
+    if s is None:
+        s= _int_structs[n]= struct.Struct('<%di' % n)
+    return s
+
+_seek_lock= threading.Lock()
+def _pread(fd, size, offset):
+    '''positional read. Without os.pread (python 2) seek and read are serialized by a lock'''
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with _seek_lock:
+        stats.counters["device.seeks"]+= 1
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+def _pwrite(fd, data, offset):
+    '''positional write, see _pread'''
+    if hasattr(os, "pwrite"):
+        while data:
+            n= os.pwrite(fd, data, offset)
+            data, offset= data[n:], offset+n
+        return
+    with _seek_lock:
+        stats.counters["device.seeks"]+= 1
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data= data[os.write(fd, data):]
+
+class FileDevice:
+    '''a device on an image file or block device.
+    Devices read and write bytes at offsets: SofsFormat, BlockCache and Journal only use
+    pread, pwrite, sync and close, so any object with those methods can hold a FS'''
+    def __init__(self, filename):
+        self.filename= filename
+        self.fd= os.open(filename, os.O_RDWR)
+
+    def pread(self, size, offset):
+        return _pread(self.fd, size, offset)
+
+    def pwrite(self, data, offset):
+        _pwrite(self.fd, data, offset)
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+class MemoryDevice:
+    '''a RAM disk: the device is a bytearray, and is lost when the process ends'''
+    def __init__(self, data):
+        '''data: the initial device contents, a bytearray that the device then owns'''
+        self.data= data
+
+    @staticmethod
+    def fromFile(filename):
+        '''returns a device holding a copy of an image file. The file is not changed'''
+        with open(filename, "rb") as f:
+            return MemoryDevice( bytearray(f.read()) )
+
+    def pread(self, size, offset):
+        return str( self.data[offset:offset+size] )
+
+    def pwrite(self, data, offset):
+        self.data[offset:offset+len(data)]= data
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+class LatencyDevice:
+    '''wraps a device, sleeping on each operation to simulate slow storage, and counting operations'''
+    def __init__(self, device, read_latency=0.0, write_latency=0.0, sync_latency=0.0):
+        '''latencies are in seconds, per operation'''
+        self.device= device
+        self.read_latency, self.write_latency, self.sync_latency= read_latency, write_latency, sync_latency
+        self.counters= collections.defaultdict(int)
+
+    def pread(self, size, offset):
+        self.counters["reads"]+= 1
+        self.counters["read_bytes"]+= size
+        time.sleep(self.read_latency)
+        return self.device.pread(size, offset)
+
+    def pwrite(self, data, offset):
+        self.counters["writes"]+= 1
+        self.counters["write_bytes"]+= len(data)
+        time.sleep(self.write_latency)
+        self.device.pwrite(data, offset)
+
+    def sync(self):
+        self.counters["syncs"]+= 1
+        time.sleep(self.sync_latency)
+        self.device.sync()
+
+    def close(self):
+        self.device.close()
+
+class RWLock:
+    '''a readers-writer lock. Waiting writers go before new readers'''
+    def __init__(self):
+        self.cond= threading.Condition( threading.Lock() )
+        self.readers, self.writer, self.waiting_writers= 0, False, 0
+
+    def acquireRead(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers+= 1
+
+    def releaseRead(self):
+        with self.cond:
+            self.readers-= 1
+            if self.readers==0:
+                self.cond.notifyAll()
+
+    @contextlib.contextmanager
+    def reading(self):
+        self.acquireRead()
+        try:
+            yield
+        finally:
+            self.releaseRead()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.cond:
+            self.waiting_writers+= 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers-= 1
+            self.writer= True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer= False
+                self.cond.notifyAll()
+
+FALLOC_FL_KEEP_SIZE= 1  #fallocate mode flag, from linux/falloc.h: reserve the blocks without growing the file
+
 class BlockOutOfFS( Exception ):
     pass
 class CantFindInodeFromPath( Exception ):
@@ -27,59 +248,82 @@ class NoFreeBlocks( Exception ):
     pass
 
 class IntTable:
-    '''this class maintains a table ints on a region of a block'''
+    '''this class maintains a table ints on a region of a block.
+    The table is decoded once into memory; changes are written back as a single dirty range'''
     class NotFound( Exception ):
         pass
     class Full( Exception ):
         pass
     DEFAULT_VALUE= -1 #the default table value
-    def __init__(self, sofsblock, start_index, size, initialize=False):
+    def __init__(self, sofsblock, start_index, size, initialize=False, ints=None):
         '''
         start_index: integer index where table starts, on block
         size: number of table entries
         initialize: write DEFAULT_VALUE on whole table
+        ints: the table contents, if the caller has already decoded them
         '''
         assert isinstance( sofsblock, SofsBlock)
         self.block, self.start_index, self.size= sofsblock, start_index, size
+        self.dirty_start, self.dirty_end= size, 0   #empty dirty range
         if initialize:
             #write the table filled with empty value
-            self.writeInts(0, (self.DEFAULT_VALUE,)*size )
+            self.ints= array.array('i', (self.DEFAULT_VALUE,)*size)
+            self._markDirty(0, size)
+            self.flush()
+        elif ints is not None:
+            assert len(ints)==size
+            self.ints= array.array('i', ints)
+        else:
+            self.ints= array.array('i', self.block.readInts( start_index, size ))
+
+    def _markDirty(self, start, end):
+        self.dirty_start= min(self.dirty_start, start)
+        self.dirty_end= max(self.dirty_end, end)
+
+    def flush(self):
+        '''writes the dirty range of the table back to the block'''
+        if self.dirty_start < self.dirty_end:
+            self.block.writeInts( self.start_index + self.dirty_start, self.ints[self.dirty_start:self.dirty_end])
+            self.dirty_start, self.dirty_end= self.size, 0
 
     def writeInt( self, index, integer):
         assert 0 <= index < self.size
-        self.block.writeInt( self.start_index + index, integer)
+        self.ints[index]= integer
+        self._markDirty(index, index+1)
+        self.flush()
 
     def writeInts( self, index, integers):
         assert 0<= index
         assert index+len(integers) <= self.size
-        self.block.writeInts( self.start_index + index, integers)
+        self.ints[index:index+len(integers)]= array.array('i', integers)
+        self._markDirty(index, index+len(integers))
+        self.flush()
 
     def readInt( self, index):
         assert 0 <= index < self.size
-        return self.block.readInt( self.start_index + index )
+        return self.ints[index]
 
     def readInts(self, index, size):
         assert 0<= index+size <= self.size
-        return self.block.readInts( self.start_index + index, size)
+        return self.ints[index:index+size].tolist()
 
     def readAllInts(self):
-        return self.readInts(0, self.size)
+        return self.ints.tolist()
 
     def readAllNonDefaultInts(self):
-        return filter( lambda x: x!=self.DEFAULT_VALUE, self.readAllInts() )
+        return [x for x in self.ints if x!=self.DEFAULT_VALUE]
 
     def index(self, value):
         '''finds the table index of the wanted value'''
-        i= self.readAllInts()
         try:
-            return i.index(value)
-        except:
+            return self.ints.index(value)
+        except ValueError:
             raise BlockTable.NotFound(value)
 
 class BlockTable( IntTable ):
     '''maintains a list of block pointers on disk'''
-    def __init__(self, sofsblock, start_index, size, initialize=False, index_to_block_function=lambda x:None):
-        IntTable.__init__(self, sofsblock, start_index, size, initialize=initialize)
+    def __init__(self, sofsblock, start_index, size, initialize=False, index_to_block_function=lambda x:None, ints=None):
+        IntTable.__init__(self, sofsblock, start_index, size, initialize=initialize, ints=ints)
         self.bfif= index_to_block_function
 
     def readBlock( self, index):
@@ -93,7 +337,7 @@ class BlockTable( IntTable ):
     
     def writeBlocks( self, index, blocks ):
         bi= [b.index for b in blocks]
-        self.writeInt(index, bi)
+        self.writeInts(index, bi)
 
     def readAllBlocks(self):
         '''returns all blocks (ignores EMPTY_VALUE)'''
@@ -114,12 +358,12 @@ class BlockTable( IntTable ):
 
 class LinearBlockTable( IntTable ):
     '''a BlockTable with no "empty spaces" between blocks'''
-    def __init__(self, sofsblock, start_index, size, initialize=False, index_to_block_function=lambda x:None):
-        IntTable.__init__(self, sofsblock, start_index, size, initialize=initialize)
+    def __init__(self, sofsblock, start_index, size, initialize=False, index_to_block_function=lambda x:None, ints=None):
+        IntTable.__init__(self, sofsblock, start_index, size, initialize=initialize, ints=ints)
         self.bfif= index_to_block_function
         
         #check that all non-empty blocks are continuous and before DEFAULT_VALUEs
-        indexes= self.readAllInts()
+        indexes= self.ints
         if self.DEFAULT_VALUE in indexes:
             i= indexes.index( self.DEFAULT_VALUE )
             empty_part= indexes[i:]
@@ -162,18 +406,206 @@ class AllocatedBlockTable( LinearBlockTable ):
         diff=  n_blocks - self.current_size
         if diff < 0:
             deallocated_blocks= self.deleteBlocks( -diff )
-            map( SofsBlock.deallocate, deallocated_blocks)
+            self.sofs.bitmap.free( [b.index for b in deallocated_blocks] )
         if diff > 0:
-            allocated_blocks= [ SofsBlock.allocateBlock(self.sofs) for x in xrange(diff) ]
+            allocated_blocks= map( self.sofs.getBlock, self.sofs.bitmap.allocate(diff) )
             self.addBlocks( allocated_blocks )
 
-
-class SofsBlock:
-    def __init__( self, sofs, index, BLOCK_SIZE=512, INT_SIZE=4):
+class BlockMap:
+    '''maps file block numbers to device blocks, through an inode's direct table and its
+    single and double indirect pointer blocks. The whole map is kept in memory.
+    Blocks that were never written are holes, DEFAULT_VALUE in the map and the tables, and
+    pointer blocks are only allocated for ranges that hold some data block'''
+    def __init__(self, inode, direct, indirect_index, double_index, n_blocks):
+        '''
+        direct: the IntTable of the inode data table
+        indirect_index, double_index: the inode pointers to the indirect blocks, or DEFAULT_VALUE
+        n_blocks: the file size, in blocks
+        '''
+        self.inode, self.sofs, self.direct= inode, inode.sofs, direct
+        self.per_block= inode.TOTAL_INTS    #pointers in an indirect block
+        self.indirect= self.double= None
+        self.double_tables= {}  #position in the double indirect block -> pointer table
+        if indirect_index!=IntTable.DEFAULT_VALUE:
+            self.indirect= self._pointerTable( indirect_index )
+        if double_index!=IntTable.DEFAULT_VALUE:
+            self.double= self._pointerTable( double_index )
+            for k, index in enumerate(self.double.ints):
+                if index!=IntTable.DEFAULT_VALUE:
+                    self.double_tables[k]= self._pointerTable( index )
+        self.map= array.array('i', (IntTable.DEFAULT_VALUE,))*n_blocks
+        for start, _, table in self._tables():
+            end= min(start+table.size, n_blocks)
+            if start < end:
+                self.map[start:end]= table.ints[:end-start]
+
+    def _pointerTable(self, index, initialize=False):
+        return IntTable( SofsBlock(self.sofs, index), 0, self.per_block, initialize=initialize )
+
+    def capacity(self):
+        return self.direct.size + self.per_block + self.per_block**2
+
+    def __len__(self):
+        return len(self.map)
+
+    def _locate(self, i):
+        '''returns the key of the table holding the pointer of file block i, and the position in it.
+        Keys are None for the direct table, -1 for the indirect block and k for the k-th double indirect table'''
+        if i < self.direct.size:
+            return None, i
+        i-= self.direct.size
+        if i < self.per_block:
+            return -1, i
+        i-= self.per_block
+        return i / self.per_block, i % self.per_block
+
+    def _table(self, key):
+        if key is None:
+            return self.direct
+        if key==-1:
+            return self.indirect
+        return self.double_tables.get(key)
+
+    def _tables(self):
+        '''yields (first file block, key, table) for the existing tables'''
+        yield 0, None, self.direct
+        if self.indirect is not None:
+            yield self.direct.size, -1, self.indirect
+        for k in sorted(self.double_tables):
+            yield self.direct.size + (k+1)*self.per_block, k, self.double_tables[k]
+
+    def resize(self, n_blocks, allocate=True):
+        '''resizes the file to n_blocks, freeing the blocks past the end.
+        allocate: allocate the new blocks, else leave them as holes'''
+        assert n_blocks <= self.capacity()
+        with self.sofs.lock:
+            old= len(self.map)
+            if n_blocks < old:
+                self._shrink(n_blocks)
+            elif allocate:
+                self.reserve(old, n_blocks)
+            elif n_blocks > old:
+                self.map.extend( array.array('i', (IntTable.DEFAULT_VALUE,))*(n_blocks-old) )
+
+    def reserve(self, start, end):
+        '''grows the map to at least end blocks and allocates the holes among file blocks [start, end),
+        or raises NoFreeBlocks and changes nothing. Returns the file blocks that were holes'''
+        with self.sofs.lock:
+            old= len(self.map)
+            if end > old:
+                self.map.extend( array.array('i', (IntTable.DEFAULT_VALUE,))*(end-old) )
+            try:
+                return self.allocate(start, end)
+            except NoFreeBlocks:
+                del self.map[old:]
+                raise
+
+    def allocate(self, start, end):
+        '''allocates the holes among file blocks [start, end), and the pointer blocks they need,
+        or raises NoFreeBlocks and allocates nothing. Returns the file blocks that were holes'''
+        with self.sofs.lock:
+            holes= [i for i in xrange(start, end) if self.map[i]==IntTable.DEFAULT_VALUE]
+            if not holes:
+                return holes
+            keys= sorted( set( self._locate(i)[0] for i in holes ) )
+            missing= [k for k in keys if self._table(k) is None]
+            new_double= self.double is None and any( k >= 0 for k in missing )
+            if len(holes) + len(missing) + new_double > self.sofs.bitmap.free_count:
+                raise NoFreeBlocks()
+            if new_double:
+                index= self.sofs.bitmap.allocate(1)[0]
+                self.double= self._pointerTable( index, initialize=True )
+                self.inode.writeInt( self.inode.DOUBLE_INDIRECT, index )
+            if missing:
+                for k, index in zip( missing, self.sofs.bitmap.allocate(len(missing)) ):
+                    if k==-1:
+                        self.indirect= self._pointerTable( index, initialize=True )
+                        self.inode.writeInt( self.inode.INDIRECT, index )
+                    else:
+                        self.double_tables[k]= self._pointerTable( index, initialize=True )
+                        self.double.writeInt( k, index )
+            self._setPointers( zip( holes, self.sofs.bitmap.allocate(len(holes)) ) )
+            return holes
+
+    def _setPointers(self, pointers):
+        '''points file blocks to device blocks, given (file block, device block) in file block order'''
+        touched= []
+        for i, index in pointers:
+            self.map[i]= index
+            key, slot= self._locate(i)
+            table= self._table(key)
+            table.ints[slot]= index
+            table._markDirty(slot, slot+1)
+            if not touched or touched[-1] is not table:
+                touched.append(table)
+        for table in touched:
+            table.flush()   #one write per table
+
+    def relocate(self, pointers):
+        '''points allocated file blocks to other device blocks, given (file block, device block) in
+        file block order. Returns the device blocks they used, which the caller frees'''
+        with self.sofs.lock:
+            old= [self.map[i] for i, _ in pointers]
+            self._setPointers(pointers)
+            return old
+
+    def _shrink(self, n_blocks):
+        freed= [i for i in self.map[n_blocks:] if i!=IntTable.DEFAULT_VALUE]
+        del self.map[n_blocks:]
+        for start, key, table in list( self._tables() ):
+            if key is not None and start >= n_blocks:
+                #the table is past the end: drop it
+                freed.append( table.block.index )
+                if key==-1:
+                    self.indirect= None
+                    self.inode.writeInt( self.inode.INDIRECT, IntTable.DEFAULT_VALUE )
+                else:
+                    del self.double_tables[key]
+                    self.double.writeInt( key, IntTable.DEFAULT_VALUE )
+            elif start + table.size > n_blocks:
+                #clear the pointers past the end
+                lo= max(n_blocks - start, 0)
+                if table.ints[lo:].count( IntTable.DEFAULT_VALUE )!=table.size-lo:
+                    table.writeInts( lo, (IntTable.DEFAULT_VALUE,)*(table.size-lo) )
+        if self.double is not None and not self.double_tables:
+            freed.append( self.double.block.index )
+            self.inode.writeInt( self.inode.DOUBLE_INDIRECT, IntTable.DEFAULT_VALUE )
+            self.double= None
+        if freed:
+            self.sofs.bitmap.free(freed)
+
+    def fragments(self):
+        '''returns the number of runs of physically consecutive data blocks, not counting holes'''
+        runs, prev= 0, None
+        for index in self.map:
+            if index==IntTable.DEFAULT_VALUE:
+                continue
+            if prev is None or index!=prev+1:
+                runs+= 1
+            prev= index
+        return runs
+
+    def allocatedBlocks(self):
+        '''returns the number of data blocks that are not holes'''
+        return len(self.map) - self.map.count( IntTable.DEFAULT_VALUE )
+
+    def dataBlocks(self):
+        '''returns the indexes of the allocated data blocks'''
+        return [i for i in self.map if i!=IntTable.DEFAULT_VALUE]
+
+    def pointerBlocks(self):
+        '''returns the indexes of the indirect pointer blocks'''
+        tables= [self.indirect, self.double] + self.double_tables.values()
+        return [t.block.index for t in tables if t is not None]
+
+
+class SofsBlock(object):
+    __slots__= ('BLOCK_SIZE', 'INT_SIZE', 'TOTAL_INTS', 'sofs', 'index')
+    def __init__( self, sofs, index):
         if hasattr(sofs, "zero_block"):
             if index>= sofs.zero_block.block_count or index<0:
                 raise BlockOutOfFS(str(index))
-        self.BLOCK_SIZE, self.INT_SIZE= BLOCK_SIZE, INT_SIZE
+        self.BLOCK_SIZE, self.INT_SIZE= sofs.BLOCK_SIZE, sofs.INT_SIZE   #the block size is read from block 0
         self.TOTAL_INTS= self.BLOCK_SIZE / self.INT_SIZE
         self.sofs= sofs
         self.index= index
@@ -188,14 +620,22 @@ class SofsBlock:
         #log.debug("block: reading {0} bytes from index {1} of block {2}".format(size, index, self.index))
         return self.sofs._readBytes( self.index*self.BLOCK_SIZE + index, size)
 
+    def getView( self, index=0, size=None ):
+        '''returns a zero-copy view of the block bytes, valid until the block is written'''
+        if size is None:
+            size= self.BLOCK_SIZE - index
+        assert 0 <= index and index+size <= self.BLOCK_SIZE
+        return self.sofs.getView( self.index*self.BLOCK_SIZE + index, size)
+
     def writeInt(self, int_index, the_int):
-        log.debug("writing int {0} to offset {1} of block {2}".format(the_int, int_index, self.index))
+        if DEBUG:
+            log.debug("writing int {0} to offset {1} of block {2}".format(the_int, int_index, self.index))
         to_write= struct.pack('<i', the_int)
         assert len(to_write)==self.INT_SIZE
         self._writeBytes( int_index*self.INT_SIZE, to_write)
 
     def writeInts(self, int_index, ints):
-        to_write= "".join( [struct.pack('<i', i) for i in ints])
+        to_write= _intStruct( len(ints) ).pack( *ints )
         assert len(to_write)==self.INT_SIZE*len(ints)
         self._writeBytes( int_index*self.INT_SIZE, to_write)
 
@@ -206,57 +646,47 @@ class SofsBlock:
         return the_int
 
     def readInts(self, int_index, size):
-        def chunks(l, n):
-            """ Yield successive n-sized chunks from l"""
-            for i in xrange(0, len(l), n):
-                yield l[i:i+n]
         ints_bytes= self._readBytes( int_index*self.INT_SIZE, self.INT_SIZE*size )
-        ints= [struct.unpack('<i', ib)[0] for ib in chunks( ints_bytes,self.INT_SIZE )]
-        return ints
+        return list( _intStruct( size ).unpack( ints_bytes ) )
 
     @staticmethod
     def allocateBlock(sofs):
-        fb= sofs.getFreeBlock()         #get free block from head
-        nfbi= fb.getNextFreeBlockIndex()#get next free block
-        sofs.zero_block.setFirstFreeBlockIndex( nfbi )   #update head
-        log.debug("allocated block "+str(nfbi))
-        return SofsBlock(sofs, fb.index)
+        index= sofs.bitmap.allocate(1)[0]
+        if DEBUG:
+            log.debug("allocated block "+str(index))
+        return SofsBlock(sofs, index)
 
     def deallocate(self):
-        log.debug("deallocating block "+str(self.index))
-        try:
-            fb= self.sofs.getFreeBlock()         #get current head
-            next_free_index = fb.index
-        except NoFreeBlocks:
-            next_free_index= -1
-        self.writeInt(0, next_free_index )               #update next pointer
-        self.sofs.zero_block.setFirstFreeBlockIndex( self.index ) #update head
+        if DEBUG:
+            log.debug("deallocating block "+str(self.index))
+        self.sofs.bitmap.free( [self.index] )
 
 class ZeroBlock( SofsBlock ):
     MAGIC_1, MAGIC_2= -1700156774, 1834985411 # signed ints for 0x9aa9aa9a, 0x6d5fa7c3
+    MAGIC_2_BITMAP= 1834985412  # 0x6d5fa7c4: free space is kept in a bitmap, int 4 points to the InfoBlock
     TABLE_START= 5
     def __init__( self, sofs ):
         SofsBlock.__init__(self, sofs, 0) #block number 0
         magic_1, magic_2, block_size, block_count, free_list_head= map(self.readInt,range( self.TABLE_START ))
-        if magic_1!=self.MAGIC_1 or magic_2!=self.MAGIC_2:
+        if magic_1!=self.MAGIC_1 or magic_2 not in (self.MAGIC_2, self.MAGIC_2_BITMAP):
             e= IOError("Bad FS magic number")
             e.errno= errno.EINVAL
             raise e
         assert block_size==self.BLOCK_SIZE
         self.block_count= block_count   #total FS blocks
-        self.free_list_head= free_list_head  #first free block
+        self.legacy= magic_2==self.MAGIC_2  #free space is a linked list of FreeBlocks
+        if self.legacy:
+            self.free_list_head, self.info_block_index= free_list_head, -1  #first free block
+        else:
+            self.free_list_head, self.info_block_index= -1, free_list_head
         table_size= self.TOTAL_INTS - ZeroBlock.TABLE_START
         self.inodes= BlockTable( self, self.TABLE_START, table_size, index_to_block_function=self.sofs.getInodeBlock)
         
-    def getFirstFreeBlockIndex(self):
-        i= self.free_list_head
-        if i==-1:
-            raise NoFreeBlocks()
-        return i
-
-    def setFirstFreeBlockIndex(self, index):
-        self.free_list_head= index
+    def setInfoBlockIndex(self, index):
+        '''switches the FS to the bitmap format, described by the InfoBlock at index'''
+        self.writeInt(1, self.MAGIC_2_BITMAP)
         self.writeInt(4, index)
+        self.legacy, self.free_list_head, self.info_block_index= False, -1, index
 
     def getBlockCount(self):
         return self.block_count
@@ -264,162 +694,1646 @@ class ZeroBlock( SofsBlock ):
 class INodeBlock( SofsBlock ):
     MAGIC= -274792711 #signed int for 0xf9fe9eef
     DATA_TABLE_START= 18
-    DATA_TABLE_SIZE=  100
-    MAX_FILE_SIZE= 512 * DATA_TABLE_SIZE
+    TAIL_INTS= 10   #the data table fills the block up to the last TAIL_INTS ints
+    TYPE_DIR= 1
+    HOLES= True     #may grow with holes on sparse mounts
+    HEADER= struct.Struct('<i64si')   #magic, filename, size
+    INLINE_FILE= 1  #value of the inline flag of a file whose bytes are in the data table
+    __slots__= ('filename', 'size', 'type', 'inline', 'reserved', 'fallocated', 'block_map', 'lock', 'unlinked', 'opened', '__weakref__')
+
+    #the layout depends on the block size. 512 byte blocks have a 100 pointer data table, at ints 18 to 117
+    @property
+    def DATA_TABLE_SIZE(self):
+        return self.TOTAL_INTS - self.DATA_TABLE_START - self.TAIL_INTS
+    @property
+    def INDIRECT(self):
+        '''int offset of the indirect pointer, followed by the double indirect one'''
+        return self.TOTAL_INTS - self.TAIL_INTS
+    @property
+    def DOUBLE_INDIRECT(self):
+        return self.INDIRECT + 1
+    @property
+    def TYPE(self):
+        '''int offset of the inode type: DEFAULT_VALUE for regular files, TYPE_DIR for directories'''
+        return self.INDIRECT + 2
+    @property
+    def INLINE(self):
+        '''int offset of the inline flag: INLINE_FILE while the file bytes are kept in the data table'''
+        return self.TYPE + 2
+    @property
+    def RESERVED(self):
+        '''int offset of the number of file blocks in the block map, when there are blocks reserved past
+        the end of the file (see preallocate), else DEFAULT_VALUE'''
+        return self.TYPE + 3
+    @property
+    def FALLOCATED(self):
+        '''int offset of the number of file blocks reserved by preallocate with keep_size, when it is more than
+        the file needs, else DEFAULT_VALUE. Blocks reserved past it were reserved by writes (see trimReserved)'''
+        return self.TYPE + 4
+    @property
+    def INLINE_SIZE(self):
+        '''largest file kept inline'''
+        return self.DATA_TABLE_SIZE * self.INT_SIZE
+    @property
+    def MAX_FILE_SIZE(self):
+        '''8,505,344 bytes with 512 byte blocks, and the 2 GB the size int allows from 4 KB blocks on'''
+        blocks= self.DATA_TABLE_SIZE + self.TOTAL_INTS + self.TOTAL_INTS**2
+        return min( self.BLOCK_SIZE*blocks, 2**31-1 )   #the size is a signed int
+
     def __init__(self, sofs, index):
+        '''decodes the whole inode from a single block read. Use SofsFormat.getInodeBlock, which caches inodes'''
         SofsBlock.__init__(self, sofs, index)
-        magic= self.readInt(0)
+        raw= self._readBytes( 0, self.BLOCK_SIZE )
+        magic, filename, self.size= self.HEADER.unpack_from( raw )
         if magic!=self.MAGIC:
             raise NotAnInodeBlock()
-        self.filename=  self._readBytes( 1*self.INT_SIZE, 64 )
-        self.filename= self.filename.split("\0")[0]
-        self.size= self.readInt(17)
-        self.data_blocks= AllocatedBlockTable( self.sofs, self, self.DATA_TABLE_START, self.DATA_TABLE_SIZE, index_to_block_function=self.sofs.getBlock)
+        self.filename= filename.split("\0")[0]
+        table= _intStruct( self.DATA_TABLE_SIZE ).unpack_from( raw, self.DATA_TABLE_START*self.INT_SIZE )
+        direct= IntTable( self, self.DATA_TABLE_START, self.DATA_TABLE_SIZE, ints=table )
+        indirect, double, self.type, _, inline, self.reserved, self.fallocated= _intStruct(7).unpack_from( raw, self.INDIRECT*self.INT_SIZE )
+        self.inline= inline==self.INLINE_FILE
+        n_blocks= 0 if self.inline else max( self.needed_blocks(self.size), self.reserved )
+        self.block_map= BlockMap( self, direct, indirect, double, n_blocks )
+        self.lock= RWLock()     #held by SoFS operations on the file
+        self.unlinked= False
+        self.opened= 0  #open SofsFile handles
 
     def getFilename(self):
         return self.filename
 
-    def setFilename(self, filename):
+    @staticmethod
+    def checkFilename(filename):
         if len(filename)>63:
             e= IOError()
             e.errno= errno.ENAMETOOLONG
             raise e
+
+    def setFilename(self, filename):
+        self.checkFilename(filename)
         self._writeBytes( SofsFormat.INT_SIZE, filename+"\0")
         self.filename= filename
 
     def getSize(self):
         return self.size
 
-    def setSize(self, newsize):
-        log.debug("setSize to "+str(newsize))
+    def setSize(self, newsize, written=None):
+        '''resizes the file. The bytes it grows by read as zeros, except from written on: writeFile
+        passes the offset of the bytes it is about to write'''
+        if DEBUG:
+            log.debug("setSize to "+str(newsize))
         if newsize > self.MAX_FILE_SIZE:
             e= IOError()
             e.errno= errno.EFBIG
             raise e
-        self.data_blocks.resize( self.needed_blocks(newsize) )
+        if self.inline:
+            if newsize <= self.INLINE_SIZE:
+                if newsize > self.size:
+                    self._writeBytes( self.DATA_TABLE_START*self.INT_SIZE + self.size, "\0"*(newsize-self.size) )   #grows with zeros
+                self.writeInt(17, newsize)
+                self.size= newsize
+                return
+            if not (self.sofs.sparse and self.HOLES) and self.needed_blocks(newsize) > self.sofs.bitmap.free_count:
+                raise NoFreeBlocks()    #while the file is still inline
+            self._migrate()
+        n_blocks= self.needed_blocks(newsize)
+        if newsize < self.size:
+            self._shrinkSteps(n_blocks)
+        elif n_blocks > len(self.block_map):   #else it grows into its reserved blocks
+            if self.sofs.sparse and self.HOLES:
+                self.block_map.resize( n_blocks, allocate=False )
+            else:
+                old= len(self.block_map)
+                try:
+                    self._reserveSteps(old, n_blocks)
+                except NoFreeBlocks:
+                    self._shrinkSteps(old)
+                    raise
+        #the bytes past the end of the file, in its last block and in reserved blocks, are not kept zeroed
+        self._zero( self.size, newsize if written is None else min(newsize, written) )
         self.writeInt(17, newsize)
         self.size= newsize
+        self._setReserved()
+
+    def _setReserved(self):
+        '''records whether the block map goes past the end of the file (see RESERVED and FALLOCATED)'''
+        needed= self.needed_blocks(self.size)
+        reserved= len(self.block_map) if len(self.block_map) > needed else IntTable.DEFAULT_VALUE
+        fallocated= min( self.fallocated, len(self.block_map) )
+        if fallocated <= needed:
+            fallocated= IntTable.DEFAULT_VALUE
+        if (reserved, fallocated)!=(self.reserved, self.fallocated):
+            self.writeInts( self.RESERVED, (reserved, fallocated) )
+            self.reserved, self.fallocated= reserved, fallocated
+
+    def trimReserved(self):
+        '''frees the blocks that writes reserved past the end of the file (see SofsFormat.prealloc), keeping those
+        reserved by preallocate with keep_size. Called when the last handle is released, and at unmount'''
+        keep= max( self.needed_blocks(self.size), self.fallocated )
+        if not self.inline and len(self.block_map) > keep:
+            self._shrinkSteps(keep)
+
+    def _reserveSteps(self, start, end):
+        '''reserves file blocks [start, end) like BlockMap.reserve, in steps that each fit in the journal (see
+        Journal.boundary). Holes filled inside the file are zeroed. Raises NoFreeBlocks, keeping the steps done.
+        A file without holes gets the blocks between its block map and start too'''
+        if not (self.sofs.sparse and self.HOLES):
+            start= min( start, len(self.block_map) )
+        #a step writes at most a bitmap block per data block, three more for pointer tables, two pointer
+        #tables, the double indirect block, the inode and the info block
+        n= end-start if not self.sofs.journal.enabled else max( 1, self.sofs.journal.step - 8 )
+        for lo in xrange(start, end, n):
+            self.sofs.journal.boundary()
+            filled= self.block_map.reserve( lo, min(lo+n, end) )
+            for i in filled:
+                if i*self.BLOCK_SIZE < self.size:   #holes in the file must still read as zeros
+                    self.sofs._writeData( self.block_map.map[i]*self.BLOCK_SIZE, "\0"*self.BLOCK_SIZE )
+            self._setReserved()
+
+    def _shrinkSteps(self, n_blocks):
+        '''shrinks the block map to n_blocks from its end, in steps that each fit in the journal. A step that
+        frees file bytes lowers the size first, so every commit leaves a shorter but consistent file'''
+        while len(self.block_map) > n_blocks:
+            self.sofs.journal.boundary()
+            target= self._shrinkTarget(n_blocks)
+            if target*self.BLOCK_SIZE < self.size:
+                self.writeInt(17, target*self.BLOCK_SIZE)
+                self.size= target*self.BLOCK_SIZE
+            self.block_map.resize(target)
+            self._setReserved()
+
+    def _shrinkTarget(self, n_blocks):
+        '''returns where the next step of shrinking to n_blocks stops: the bitmap blocks it writes, and the pointer
+        tables it changes or drops, fit in a journal step'''
+        block_map, bits= self.block_map, self.BLOCK_SIZE*8
+        if not self.sofs.journal.enabled:
+            return n_blocks
+        limit= self.sofs.journal.step - 3  #the double indirect block, the inode and the info block
+        bitmap, tables= set(), 0
+        target= len(block_map)
+        for start, key, table in reversed( list( block_map._tables() ) ):
+            end= min( start+table.size, target )
+            if end <= n_blocks:
+                break
+            lo= max(start, n_blocks)
+            freed= set( i/bits for i in block_map.map[lo:end] if i!=IntTable.DEFAULT_VALUE )
+            if key is not None:
+                freed.add( table.block.index/bits )     #the table may be dropped
+            if len(bitmap | freed) + tables+1 <= limit:
+                bitmap|= freed
+                tables+= 1
+                target= lo
+                continue
+            #only some blocks of this table fit
+            tables+= 1
+            if key is not None:
+                bitmap.add( table.block.index/bits )
+            for i in xrange(end-1, lo-1, -1):
+                index= block_map.map[i]
+                if index!=IntTable.DEFAULT_VALUE:
+                    if index/bits not in bitmap and len(bitmap) + tables >= limit and i+1 < len(block_map):
+                        return i+1
+                    bitmap.add( index/bits )
+            return lo
+        return n_blocks     #the blocks left are holes outside any table
+
+    def _zero(self, start, end):
+        '''writes zeros over file bytes [start, end), skipping holes'''
+        if start >= end:
+            return
+        chunk= self.sofs.COPY_BLOCKS*self.BLOCK_SIZE
+        for device_offset, size in self.extents(start, end-start):
+            if device_offset is not None:
+                for i in xrange(0, size, chunk):
+                    self.sofs._writeData( device_offset+i, "\0"*min(chunk, size-i) )
+
+    def preallocate(self, offset, length, keep_size=False):
+        '''allocates the blocks of file bytes [offset, offset+length), preferring one contiguous run, and
+        grows the file to offset+length unless keep_size. Blocks past the end of the file stay reserved
+        for later writes, which then allocate nothing. Raises NoFreeBlocks if there is not enough space,
+        keeping the blocks already reserved (see _reserveSteps)'''
+        end= offset+length
+        if end > self.MAX_FILE_SIZE:
+            e= IOError()
+            e.errno= errno.EFBIG
+            raise e
+        if self.inline:
+            if end <= self.INLINE_SIZE:
+                if end > self.size and not keep_size:
+                    self.setSize(end)
+                return  #the data table has room
+            self._migrate()
+        try:
+            self._reserveSteps( offset/self.BLOCK_SIZE, self.needed_blocks(end) )
+        finally:
+            if keep_size:   #kept by trimReserved, unlike the blocks writes reserve
+                self.fallocated= max( self.fallocated, min( self.needed_blocks(end), len(self.block_map) ) )
+                self._setReserved()
+        if end > self.size and not keep_size:
+            self.setSize(end)
+        self._setReserved()
 
     @staticmethod
-    def allocateInodeBlock(sofs, filename):
-        b= SofsBlock.allocateBlock(sofs)
-        b.writeInt(0, INodeBlock.MAGIC)
-        sofs.zero_block.inodes.addBlock( b)
-        inode = INodeBlock(sofs, b.index)
-        inode.setFilename(filename)
-        inode.writeInt(17, 0)   #size
-        BlockTable( inode, INodeBlock.DATA_TABLE_START, INodeBlock.DATA_TABLE_SIZE, initialize=True)    #write empty data_blocks table
+    def allocateInodeBlock(sofs, filename, directory=False):
+        '''allocates an empty file, or an empty directory. The caller adds it to a directory'''
+        INodeBlock.checkFilename(filename)
+        with sofs.lock:
+            b= SofsBlock.allocateBlock(sofs)
+            #magic, empty name, size 0, empty data table and unused ints
+            empty= (IntTable.DEFAULT_VALUE,)*(b.TOTAL_INTS - INodeBlock.DATA_TABLE_START)
+            b._writeBytes(0, INodeBlock.HEADER.pack(INodeBlock.MAGIC, "", 0) + _intStruct(len(empty)).pack(*empty))
+            if directory:
+                inode= INodeBlock(sofs, b.index)
+                inode.writeInts( inode.TYPE, (INodeBlock.TYPE_DIR, 0) )    #no entries
+            elif sofs.inline:
+                inode= INodeBlock(sofs, b.index)
+                inode.writeInt( inode.INLINE, INodeBlock.INLINE_FILE )
+            sofs.info_block.addInodes(1)
+            inode = sofs.getInodeBlock(b.index)
+            inode.setFilename(filename)
+            if directory:
+                inode._addBucket()
         return inode
 
+    def _migrate(self):
+        '''moves the inline bytes to data blocks.
+        Raises NoFreeBlocks, leaving the file inline, if there is not enough space'''
+        data= self.readFile(self.size, 0)
+        empty= (IntTable.DEFAULT_VALUE,)*self.DATA_TABLE_SIZE
+        block_map= BlockMap( self, IntTable(self, self.DATA_TABLE_START, self.DATA_TABLE_SIZE, ints=empty),
+                             IntTable.DEFAULT_VALUE, IntTable.DEFAULT_VALUE, 0 )
+        block_map.reserve( 0, self.needed_blocks(len(data)) )
+        blocks= block_map.map[:]
+        for i, index in enumerate(blocks):
+            self.sofs._writeData( index*self.BLOCK_SIZE, data[i*self.BLOCK_SIZE:(i+1)*self.BLOCK_SIZE] )
+        self.sofs.syncData(blocks)  #before the table that points to them replaces the inline bytes
+        block_map.direct.writeInts( 0, block_map.direct.ints )
+        self.writeInt( self.INLINE, IntTable.DEFAULT_VALUE )
+        self.block_map, self.inline= block_map, False
+
     def needed_blocks( self, filesize ):
         '''returns the number of FS blocks to contain a file of filesize'''
         return ((filesize-1) / self.BLOCK_SIZE)+1
 
+    def extents(self, offset, length):
+        '''yields (device_offset, size) for the runs of physically consecutive blocks holding file bytes [offset, offset+length).
+        Runs of holes have a device_offset of None'''
+        indexes= self.block_map.map
+        block_to_read = offset/self.BLOCK_SIZE
+        block_offset = offset%self.BLOCK_SIZE
+        while length > 0:
+            run_start= indexes[block_to_read]
+            step= 0 if run_start==IntTable.DEFAULT_VALUE else 1
+            run_blocks= 1
+            #extend the run while the next block follows the current one on disk, or is also a hole
+            while run_blocks*self.BLOCK_SIZE - block_offset < length and \
+                    indexes[block_to_read+run_blocks]==run_start+step*run_blocks:
+                run_blocks+= 1
+            if not step:
+                run_start= None
+            size= min( run_blocks*self.BLOCK_SIZE - block_offset, length )
+            yield (None if run_start is None else run_start*self.BLOCK_SIZE + block_offset), size
+            length-= size
+            block_to_read+= run_blocks
+            block_offset= 0
+
+    @_timed("readFile")
     def readFile(self, readlen, offset):
         if offset + readlen > self.size:
             readlen= self.getSize() - offset
-        if readlen==0:
+        if readlen<=0:
             return ""   #to avoid index error
-        blocks= self.data_blocks.readAllBlocks()
-        block_to_read = offset/self.BLOCK_SIZE              #index of the block to be read
-        block_offset = offset%self.BLOCK_SIZE
-        result = []
-        while(readlen > 0):
-            curr_block = blocks[block_to_read]                  #current block to be read
-            block_bytes = self.BLOCK_SIZE - block_offset
-            bytes_to_read = min( block_bytes, readlen)
-            result.append(curr_block._readBytes(block_offset, bytes_to_read))
-            readlen -= bytes_to_read
-            block_to_read += 1
-            block_offset = 0
-        return "".join(result)
-
+        if self.inline:
+            return self._readBytes( self.DATA_TABLE_START*self.INT_SIZE + offset, readlen )
+        result = bytearray(readlen)
+        result_index = 0
+        for device_offset, size in self.extents(offset, readlen):
+            if device_offset is not None:   #holes read as the zeros result starts with
+                result[result_index:result_index+size] = self.sofs.getView(device_offset, size)
+            result_index += size
+        return str(result)
+
+    @_timed("writeFile")
     def writeFile(self, buf, offset):
-        if offset + len(buf) > self.size:     
-            self.setSize(offset + len(buf))
-        blocks= self.data_blocks.readAllBlocks()
-        block_to_write = offset/self.BLOCK_SIZE                 #index of the block to be written
-        block_offset = offset%self.BLOCK_SIZE
-        remaining_bytes=len(buf)
+        if not buf:
+            return
+        end= offset + len(buf)
+        size= self.size
+        if end > self.size:
+            if self.sofs.prealloc and not self.inline and offset <= self.size and self.needed_blocks(end) > len(self.block_map):
+                #a sequential write past the reserved blocks: reserve some more
+                try:
+                    self._reserveSteps( len(self.block_map), self.needed_blocks(end) + self.sofs.prealloc )
+                except NoFreeBlocks:
+                    pass    #setSize allocates what the write needs, if it can
+            self.setSize(end, written=offset)
+        if self.inline:
+            self._writeBytes( self.DATA_TABLE_START*self.INT_SIZE + offset, buf )
+            return
+        first, last= offset/self.BLOCK_SIZE, (offset+len(buf)-1)/self.BLOCK_SIZE
+        try:
+            filled= self.block_map.allocate(first, last+1)
+        except NoFreeBlocks:
+            if self.size!=size:
+                #setSize didn't zero the bytes this write was to cover. The blocks it took stay reserved
+                self.writeInt(17, size)
+                self.size= size
+                self._setReserved()
+            raise
+        #blocks that were holes must read as zeros where buf does not cover them
+        partial= [i for i, covered in ((first, offset%self.BLOCK_SIZE==0), (last, (offset+len(buf))%self.BLOCK_SIZE==0)) if not covered]
+        for i in set(partial) & set(filled):
+            self.sofs._writeData( self.block_map.map[i]*self.BLOCK_SIZE, "\0"*self.BLOCK_SIZE )
         reading_index = 0
-        while (remaining_bytes > 0):
-            curr_block = blocks[block_to_write] #current block
-            block_bytes = self.BLOCK_SIZE - block_offset
-            num_bytes_to_write = min( block_bytes, remaining_bytes)
-            curr_block._writeBytes(block_offset, buf[reading_index:reading_index+num_bytes_to_write])
-            reading_index+=num_bytes_to_write
-            block_to_write += 1                                      #get next block to write
-            block_offset = 0
-            remaining_bytes -= num_bytes_to_write
+        for device_offset, size in self.extents(offset, len(buf)):
+            self.sofs._writeData(device_offset, buf[reading_index:reading_index+size])
+            reading_index += size
     
+    def defragment(self):
+        '''moves the data blocks to a single contiguous run. Returns the number of blocks moved, or None if
+        there is no free run large enough. The caller holds the write lock.
+        With a journal, a file whose run would span more bitmap blocks than a step logs is moved in pieces,
+        each to its own run'''
+        blocks= [(i, index) for i, index in enumerate(self.block_map.map) if index!=IntTable.DEFAULT_VALUE]
+        if self.block_map.fragments() <= 1:
+            return 0
+        journal= self.sofs.journal
+        piece= len(blocks) if not journal.enabled else max( 1, journal.step - 2 ) * self.BLOCK_SIZE*8
+        moved= 0
+        for p in xrange(0, len(blocks), piece):
+            part= blocks[p:p+piece]
+            with journal.transaction():
+                new= self.sofs.bitmap.allocateRun( len(part) )
+            if new is None:
+                return moved or None
+            i= 0
+            while i < len(part):
+                #copy each run of consecutive blocks with one read and one write
+                j= i+1
+                while j < len(part) and j-i < self.sofs.COPY_BLOCKS and part[j][1]==part[j-1][1]+1:
+                    j+= 1
+                self.sofs._writeData( new[i]*self.BLOCK_SIZE, self.sofs._readBytes( part[i][1]*self.BLOCK_SIZE, (j-i)*self.BLOCK_SIZE ) )
+                i= j
+            self.sofs.syncData(new)     #before the tables point to the copies
+            pointers= [(i, index) for (i, _), index in zip(part, new)]
+            n= len(pointers) if not journal.enabled else max( 1, journal.step - 6 )
+            with journal.transaction():
+                for k in xrange(0, len(pointers), n):
+                    #each step changes two pointer tables, and frees a block per pointer
+                    journal.boundary()
+                    self.sofs.bitmap.free( self.block_map.relocate( pointers[k:k+n] ) )
+            moved+= len(part)
+        return moved
+
     def unlink(self):
-        '''frees data blocks and inode block'''
-        self.sofs.zero_block.inodes.deleteBlock( self )
-        for block in self.data_blocks.readAllBlocks():
-            block.deallocate()
-        self.deallocate()
-        
+        '''frees data blocks and inode block. The caller removes the directory entry afterwards, in the same
+        transaction: freeing a large file takes several commits, each leaving it shorter (see _shrinkSteps)'''
+        self._shrinkSteps(0)
+        self._free()
+
+    def _free(self):
+        with self.sofs.lock:
+            self.sofs.inode_cache.pop( self.index, None )
+            self.sofs.live_inodes.pop( self.index, None )   #the block may become another inode
+            self.sofs.bitmap.free( self.block_map.dataBlocks() + self.block_map.pointerBlocks() + [self.index] )
+            self.sofs.info_block.addInodes(-1)
+            self.unlinked= True
+
+class DirectoryINode( INodeBlock ):
+    '''a directory. Its data blocks are the buckets of a linear hash table of entries: a full
+    bucket chains overflow blocks, and the table grows by one bucket, splitting an older one,
+    when the average load passes MAX_LOAD. So a lookup reads one or two blocks.
+    Callers hold the inode lock, for reading to look up and for writing to change entries'''
+    ENTRY= struct.Struct('<i64s')   #inode block index (DEFAULT_VALUE for an empty slot), name
+    NEXT= 0     #int offset of the next overflow block, on bucket blocks
+    MAX_LOAD= 0.75
+    HOLES= False
+    __slots__= ('entries',)
+    @property
+    def ENTRY_COUNT(self):
+        '''int offset of the number of entries'''
+        return self.TYPE + 1
+    @property
+    def ENTRIES_PER_BLOCK(self):
+        return (self.BLOCK_SIZE - self.INT_SIZE) / self.ENTRY.size
+
+    def __init__(self, sofs, index):
+        INodeBlock.__init__(self, sofs, index)
+        self.entries= self.readInt(self.ENTRY_COUNT)
+
+    def _bucket(self, name):
+        '''returns the bucket of a name: its hash modulo the next power of two, or the
+        previous one if that bucket has not been split yet'''
+        h= zlib.crc32(name) & 0xffffffff
+        n= len(self.block_map)
+        level= n.bit_length()-1
+        bucket= h & ((2<<level) - 1)
+        if bucket >= n:
+            bucket= h & ((1<<level) - 1)
+        return bucket
+
+    def _readBucketBlock(self, index):
+        '''returns the next overflow block index and the (slot, inode index, name) of the used slots'''
+        raw= SofsBlock(self.sofs, index)._readBytes(0, self.BLOCK_SIZE)
+        next_index= struct.unpack_from('<i', raw)[0]
+        slots= []
+        for slot in xrange(self.ENTRIES_PER_BLOCK):
+            inode, name= self.ENTRY.unpack_from( raw, self.INT_SIZE + slot*self.ENTRY.size )
+            if inode!=IntTable.DEFAULT_VALUE:
+                slots.append( (slot, inode, name.split("\0")[0]) )
+        return next_index, slots
+
+    def _chain(self, bucket):
+        '''yields (block index, next block index, used slots) for the blocks of a bucket'''
+        index= self.block_map.map[bucket]
+        while index!=IntTable.DEFAULT_VALUE:
+            next_index, slots= self._readBucketBlock(index)
+            yield index, next_index, slots
+            index= next_index
+
+    def _clearBucketBlock(self, index):
+        SofsBlock(self.sofs, index)._writeBytes(0, "\xff"*self.BLOCK_SIZE)   #no next block, empty slots
+
+    def _writeEntry(self, index, slot, inode_index, name):
+        SofsBlock(self.sofs, index)._writeBytes( self.INT_SIZE + slot*self.ENTRY.size, self.ENTRY.pack(inode_index, name) )
+
+    def _setEntries(self, entries):
+        self.writeInt(self.ENTRY_COUNT, entries)
+        self.entries= entries
+
+    def _addBucket(self):
+        n= len(self.block_map)
+        self.setSize( (n+1)*self.BLOCK_SIZE, written=n*self.BLOCK_SIZE )    #the new bucket is cleared instead of zeroed
+        self._clearBucketBlock( self.block_map.map[n] )
+
+    def _insert(self, name, inode_index):
+        last= None
+        for index, next_index, slots in self._chain( self._bucket(name) ):
+            if len(slots) < self.ENTRIES_PER_BLOCK:
+                used= set( slot for slot, _, _ in slots )
+                slot= min( set(xrange(self.ENTRIES_PER_BLOCK)) - used )
+                self._writeEntry(index, slot, inode_index, name)
+                return
+            last= index
+        overflow= SofsBlock.allocateBlock(self.sofs)
+        self._clearBucketBlock(overflow.index)
+        self._writeEntry(overflow.index, 0, inode_index, name)
+        SofsBlock(self.sofs, last).writeInt(self.NEXT, overflow.index)
+
+    def _split(self):
+        '''adds a bucket, and moves to it the entries of the bucket it splits'''
+        n= len(self.block_map)
+        split= n - (1 << (n.bit_length()-1))
+        self._addBucket()
+        head= self.block_map.map[split]
+        moved, overflow= [], []
+        for index, _, slots in self._chain(split):
+            moved.extend( (name, inode) for _, inode, name in slots )
+            if index!=head:
+                overflow.append(index)
+        self._clearBucketBlock(head)
+        if overflow:
+            self.sofs.bitmap.free(overflow)
+        for name, inode in moved:
+            self._insert(name, inode)
+
+    def lookup(self, name):
+        '''returns the inode block index of an entry'''
+        for _, _, slots in self._chain( self._bucket(name) ):
+            for _, inode, entry_name in slots:
+                if entry_name==name:
+                    return inode
+        raise CantFindInodeFromPath()
+
+    def addBlocks(self, name):
+        '''returns the most blocks add(name) allocates: an overflow block if the bucket is full, and a new
+        bucket with its pointer blocks if the table splits. A split reuses the overflow blocks it frees'''
+        n= 0
+        if all( len(slots)==self.ENTRIES_PER_BLOCK for _, _, slots in self._chain( self._bucket(name) ) ):
+            n+= 1
+        if self.entries+1 > len(self.block_map)*self.ENTRIES_PER_BLOCK*self.MAX_LOAD:
+            key, _= self.block_map._locate( len(self.block_map) )
+            n+= 1 + (self.block_map._table(key) is None) + (key >= 0 and self.block_map.double is None)
+        return n
+
+    def add(self, name, inode_index):
+        '''adds an entry, or raises NoFreeBlocks and changes nothing'''
+        self.checkFilename(name)
+        if self.addBlocks(name) > self.sofs.bitmap.free_count:
+            raise NoFreeBlocks()
+        self._insert(name, inode_index)
+        self._setEntries(self.entries+1)
+        if self.entries > len(self.block_map)*self.ENTRIES_PER_BLOCK*self.MAX_LOAD:
+            try:
+                self._split()
+            except NoFreeBlocks:
+                pass    #blocks were taken since the check. The entry is in, and a later add splits the table
+
+    def remove(self, name):
+        prev= None
+        for index, next_index, slots in self._chain( self._bucket(name) ):
+            for slot, _, entry_name in slots:
+                if entry_name==name:
+                    self._writeEntry(index, slot, IntTable.DEFAULT_VALUE, "")
+                    if prev is not None and len(slots)==1:
+                        #unlink the empty overflow block
+                        SofsBlock(self.sofs, prev).writeInt(self.NEXT, next_index)
+                        self.sofs.bitmap.free([index])
+                    self._setEntries(self.entries-1)
+                    return
+            prev= index
+        raise CantFindInodeFromPath()
+
+    def _entries(self, resolve):
+        '''yields (name, inode index, or INodeBlock if resolve), reading one bucket at a time.
+        Inodes are resolved under the lock, so they are not unlinked before they are returned'''
+        bucket= 0
+        while True:
+            with self.lock.reading():
+                if self.unlinked or bucket >= len(self.block_map):
+                    return
+                entries= [(name, self.sofs.getInodeBlock(inode) if resolve else inode)
+                          for _, _, slots in self._chain(bucket) for _, inode, name in slots]
+            for entry in entries:
+                yield entry
+            bucket+= 1
+
+    def names(self):
+        '''yields the entry names. The caller must not hold the lock'''
+        return (name for name, _ in self._entries(False))
+
+    def children(self):
+        '''yields (name, INodeBlock) of the entries. The caller must not hold the lock'''
+        return self._entries(True)
+
+    def unlink(self):
+        '''frees the overflow blocks too'''
+        heads= set( self.block_map.map )
+        overflow= [index for bucket in xrange(len(self.block_map)) for index, _, _ in self._chain(bucket) if index not in heads]
+        if overflow:
+            self.sofs.bitmap.free(overflow)
+        self._free()    #an empty directory has few blocks, freed in one step
+
 
 class FreeBlock( SofsBlock ):
+    '''a block of the legacy free list'''
     def __init__(self, sofs, index):
         SofsBlock.__init__(self, sofs, index)
     def getNextFreeBlockIndex(self):
         return self.readInt(0)
         
+class InfoBlock( SofsBlock ):
+    '''describes the on-disk structures that the original format lacks'''
+    MAGIC= 1936092019   #signed int for 0x73666f73
+    FEATURE_BITMAP= 1
+    FEATURE_INDIRECT= 2 #the unused inode ints were cleared to DEFAULT_VALUE, to hold indirect pointers
+    FEATURE_JOURNAL= 4
+    FEATURE_DIRS= 8     #files are found from a root directory, instead of the table on block 0
+    FEATURE_INLINE= 16  #small files may keep their bytes in the inode data table (see INodeBlock.INLINE)
+    FEATURE_COUNTERS= 32    #the free block and inode counts are kept up to date
+    FEATURES, BITMAP_START, BITMAP_BLOCKS, JOURNAL_START, JOURNAL_BLOCKS, ROOT_DIR, FREE_BLOCKS, INODES, STATE= 1, 2, 3, 4, 5, 6, 7, 8, 9  #int offsets
+    STATE_MOUNTED= 1    #the FS is in use, or was not unmounted cleanly. DEFAULT_VALUE once it is
+    def __init__(self, sofs, index):
+        SofsBlock.__init__(self, sofs, index)
+        magic, self.features, self.bitmap_start, self.bitmap_blocks, self.journal_start, self.journal_blocks, self.root_dir, \
+            self.free_blocks, self.inode_count, self.state= self.readInts(0, 10)
+        if magic!=self.MAGIC:
+            e= IOError("Bad info block magic number")
+            e.errno= errno.EINVAL
+            raise e
+
+    def addFeatures(self, features):
+        self.features|= features
+        self.writeInt(self.FEATURES, self.features)
+
+    def setJournal(self, start, nblocks):
+        self.journal_start, self.journal_blocks= start, nblocks
+        self.writeInts(self.JOURNAL_START, (start, nblocks))
+        self.addFeatures(self.FEATURE_JOURNAL)
+
+    def setFreeBlocks(self, n):
+        self.free_blocks= n
+        self.writeInt(self.FREE_BLOCKS, n)
+
+    def addInodes(self, n):
+        self.inode_count+= n
+        self.writeInt(self.INODES, self.inode_count)
+
+    def setCounters(self, free_blocks, inode_count):
+        '''records counts found by scanning the FS, and keeps them up to date from then on'''
+        self.free_blocks, self.inode_count= free_blocks, inode_count
+        self.writeInts(self.FREE_BLOCKS, (free_blocks, inode_count))
+        self.addFeatures(self.FEATURE_COUNTERS)
+
+    def setMounted(self, mounted):
+        self.state= self.STATE_MOUNTED if mounted else IntTable.DEFAULT_VALUE
+        self.writeInt(self.STATE, self.state)
+
+    def setRootDirectory(self, index):
+        self.root_dir= index
+        self.writeInt(self.ROOT_DIR, index)
+        self.addFeatures(self.FEATURE_DIRS)
+
+    @staticmethod
+    def initialize(sofs, index, bitmap_start, bitmap_blocks):
+        b= SofsBlock(sofs, index)
+        b._writeBytes(0, "\xff"*b.BLOCK_SIZE)  #unused fields are -1
+        b.writeInts(0, (InfoBlock.MAGIC, InfoBlock.FEATURE_BITMAP, bitmap_start, bitmap_blocks))
+        return InfoBlock(sofs, index)
+
+class FreeBitmap:
+    '''the on-disk free block bitmap (a set bit is a used block), mirrored in memory'''
+    NOT_FULL= re.compile('[^\xff]')
+    def __init__(self, sofs, start, nblocks, block_count, free_count=None):
+        '''
+        start, nblocks: the contiguous run of blocks holding the bitmap
+        block_count: total FS blocks
+        free_count: the number of free blocks, if known, else the bits are counted
+        '''
+        self.sofs, self.start, self.block_count= sofs, start, block_count
+        self.bits= bytearray( sofs._readBytes( start*sofs.BLOCK_SIZE, nblocks*sofs.BLOCK_SIZE ) )
+        self.hint= 0    #next-fit search position
+        if free_count is None:
+            full_bytes= block_count>>3
+            used= sum( self.bits[:full_bytes].translate( _POPCOUNT ) )
+            used+= sum( 1 for i in xrange(full_bytes*8, block_count) if not self.isFree(i) )
+            free_count= block_count - used
+        self.free_count= free_count
+
+    @staticmethod
+    def blocksNeeded(block_count, block_size):
+        return (block_count + block_size*8 - 1) / (block_size*8)
+
+    def isFree(self, index):
+        return not self.bits[index>>3] & (1<<(index&7))
+
+    def _set(self, indexes, used):
+        for i in indexes:
+            if used:
+                self.bits[i>>3]|= 1<<(i&7)
+            else:
+                self.bits[i>>3]&= ~(1<<(i&7))
+        self.free_count+= -len(indexes) if used else len(indexes)
+        self.sofs.info_block.setFreeBlocks( self.free_count )   #in the same transaction as the bits
+        #write back the touched bytes of each bitmap block in one call, so the blocks between them are not logged
+        bs= self.sofs.BLOCK_SIZE
+        spans= {}
+        for i in indexes:
+            lo, hi= spans.get( (i>>3)/bs, (i>>3, i>>3) )
+            spans[(i>>3)/bs]= min(lo, i>>3), max(hi, i>>3)
+        for lo, hi in spans.itervalues():
+            self.sofs._writeBytes( self.start*bs + lo, str(self.bits[lo:hi+1]) )
+
+    def _findRun(self, n):
+        '''returns the first index of a byte-aligned run of at least n free blocks, or None'''
+        run= "\0"*((n+7)/8)
+        for start in (self.hint>>3, 0):
+            pos= self.bits.find(run, start)
+            if pos!=-1 and pos*8+n <= self.block_count:
+                return pos*8
+        return None
+
+    def _findFree(self, n):
+        '''returns n free block indexes, scanning from the hint'''
+        found= []
+        hint_byte= self.hint>>3
+        for start, end in ((hint_byte, len(self.bits)), (0, hint_byte)):
+            for m in self.NOT_FULL.finditer(self.bits, start, end):
+                byte_index= m.start()
+                for i in xrange(byte_index*8, min(byte_index*8+8, self.block_count)):
+                    if self.isFree(i):
+                        found.append(i)
+                        if len(found)==n:
+                            return found
+        return found
+
+    def allocate(self, n):
+        '''allocates n blocks, preferring a contiguous run. Raises NoFreeBlocks, allocating nothing, if there is not enough space'''
+        with self.sofs.lock:
+            return self._allocate(n)
+
+    def _allocate(self, n):
+        if n > self.free_count:
+            raise NoFreeBlocks()
+        if self.hint+n <= self.block_count and all( self.isFree(i) for i in xrange(self.hint, self.hint+n) ):
+            start= self.hint    #right after the last allocation, so small allocations don't each start a new byte
+        else:
+            start= self._findRun(n)
+        if start is not None:
+            indexes= range(start, start+n)
+        else:
+            indexes= self._findFree(n)
+            if len(indexes) < n:
+                raise NoFreeBlocks()
+        self._set(indexes, True)
+        self.hint= indexes[-1]+1
+        return indexes
+
+    def allocateRun(self, n):
+        '''allocates n contiguous blocks, or returns None if there is no such run'''
+        with self.sofs.lock:
+            start= self._findRun(n)
+            if start is None:
+                return None
+            indexes= range(start, start+n)
+            self._set(indexes, True)
+            self.hint= start+n
+            return indexes
+
+    def free(self, indexes):
+        if indexes:
+            with self.sofs.lock:
+                assert not any(self.isFree(i) for i in indexes), "double free"
+                self._set(indexes, False)
+
+_POPCOUNT= "".join( chr(bin(i).count("1")) for i in range(256) )
+
+
+
+class Journal:
+    '''write-ahead log of metadata blocks.
+    Metadata written inside transaction() is pinned in the block cache. commit() writes the
+    images of every pinned block to the log, a header block followed by the images, with one
+    write and one fsync, and only then lets the blocks reach their home location.
+    Transactions that end before a commit are grouped in it; commits happen on flush, when the
+    log is half full, and from the commit thread. Data blocks are not logged, but a commit first
+    writes back and syncs every other dirty block, so committed metadata never points to stale data.
+    The header is followed by more index blocks when it can't hold every index. Long operations
+    call boundary() between steps that each fit in the log (see INodeBlock._steps). Changes that
+    still don't fit are never committed in parts: the journal fails, and the FS becomes read-only.
+    Once its blocks are written home a transaction is retired, so the log only holds a transaction
+    that a crash may have interrupted'''
+    MAGIC= 1785688945   #signed int for 0x6a6f7571
+    HEADER= struct.Struct('<iiiI')  #magic, sequence, block count, crc32 of the index blocks after the header and of the images
+    MIN_BLOCKS= 32      #smaller logs can't hold the larger transactions, and are not used
+    def __init__(self, sofs, start, nblocks):
+        '''start, nblocks: the contiguous log region, start is None to disable journaling'''
+        self.sofs, self.start, self.nblocks= sofs, start, nblocks
+        self.enabled= start is not None
+        if self.enabled:
+            self.capacity= self.capacityOf( nblocks, sofs.BLOCK_SIZE )
+            self.step= self.capacity/4  #blocks a step of a long operation may log
+        else:
+            self.step= 2**31
+        self.failed= False
+        self.rwlock= RWLock()   #transactions hold it for reading, commits for writing
+        self.local= threading.local()   #transaction nesting depth of each thread
+        self.pending= set()     #blocks written by finished or running transactions
+        self.pending_lock= threading.Lock()
+        self.sequence= 0
+
+    @staticmethod
+    def indexBlocks(count, block_size):
+        '''returns the number of blocks holding the header and the indexes of a transaction of count blocks'''
+        ints= block_size/SofsFormat.INT_SIZE
+        return (Journal.HEADER.size/SofsFormat.INT_SIZE + count + ints-1) / ints
+
+    @staticmethod
+    def capacityOf(nblocks, block_size):
+        '''returns the most blocks a transaction logged in nblocks blocks can have'''
+        count= nblocks-1
+        while count > 0 and count + Journal.indexBlocks(count, block_size) > nblocks:
+            count-= 1
+        return count
+
+    @staticmethod
+    def readLog(device, start, nblocks, block_size):
+        '''returns the block indexes and images of the transaction in a log region, or None if it is empty or torn'''
+        header= device.pread( block_size, start*block_size )
+        magic, _, count, crc= Journal.HEADER.unpack_from(header)
+        if magic!=Journal.MAGIC or not 0 < count <= Journal.capacityOf(nblocks, block_size):
+            return None
+        nindex= Journal.indexBlocks(count, block_size)
+        if nindex > 1:
+            header+= device.pread( (nindex-1)*block_size, (start+1)*block_size )
+        blocks= _intStruct(count).unpack_from( header, Journal.HEADER.size )
+        images= device.pread( count*block_size, (start+nindex)*block_size )
+        extra= header[block_size:Journal.HEADER.size + count*SofsFormat.INT_SIZE]   #the indexes after the header block
+        if zlib.crc32( images, zlib.crc32(extra) ) & 0xffffffff != crc:
+            log.warning("discarding a torn journal transaction")
+            return None
+        return blocks, images
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''groups the metadata writes done inside it, so they reach the disk together'''
+        depth= getattr(self.local, "depth", 0)
+        if depth or not self.enabled:
+            self.local.depth= depth+1
+            try:
+                yield
+            finally:
+                self.local.depth= depth
+            return
+        if self.failed:
+            e= IOError("The journal failed, the FS is read-only")
+            e.errno= errno.EROFS
+            raise e
+        if len(self.pending) >= self.capacity/2:
+            self.commit()   #leaves room for this transaction
+        self.rwlock.acquireRead()
+        self.local.depth= 1
+        try:
+            yield
+        finally:
+            self.local.depth= 0
+            self.rwlock.releaseRead()
+        stats.counters["journal.transactions"]+= 1
+        if len(self.pending) >= self.capacity/2:
+            self.commit()
+
+    def boundary(self):
+        '''called by a long operation between steps that each leave the FS consistent and log at most
+        step blocks. Commits if the next step might not fit, so the operation can span several commits'''
+        if not self.enabled or getattr(self.local, "depth", 0)!=1 or len(self.pending) < self.capacity/2:
+            return
+        self.rwlock.releaseRead()
+        try:
+            self.commit()
+        finally:
+            self.rwlock.acquireRead()
+
+    def logWrite(self, first_block, last_block):
+        '''records a metadata write. Returns False if it is not part of a transaction'''
+        if not getattr(self.local, "depth", 0):
+            return False
+        blocks= range(first_block, last_block+1)
+        with self.pending_lock:
+            self.pending.update(blocks)
+        self.sofs.cache.pin(blocks)
+        return True
+
+    def commit(self):
+        if not self.enabled:
+            return
+        with self.rwlock.writing():
+            if self.failed or not self.pending:
+                return
+            if len(self.pending) > self.capacity:
+                #committed in parts, a crash could leave half a transaction on the disk
+                self.failed= True
+                log.error("{0} blocks don't fit in the journal: the FS is read-only, and the changes since the last commit are lost".format(len(self.pending)))
+                e= IOError("The changes don't fit in the journal")
+                e.errno= errno.EIO
+                raise e
+            if self.sofs.cache.flush():
+                self.sofs.device.sync()     #the data reaches the disk before the metadata that points to it
+            self._commit( sorted(self.pending) )
+            self.pending.clear()
+
+    def _commit(self, blocks):
+        cache, bs= self.sofs.cache, self.sofs.BLOCK_SIZE
+        images= "".join( str(cache.getBlock(i)) for i in blocks )
+        index= _intStruct(len(blocks)).pack(*blocks)
+        first= bs - self.HEADER.size    #index bytes in the header block
+        header= self.HEADER.pack( self.MAGIC, self.sequence, len(blocks), zlib.crc32( images, zlib.crc32(index[first:]) ) & 0xffffffff )
+        header+= index
+        header+= "\0"*(self.indexBlocks(len(blocks), bs)*bs - len(header))
+        self.sofs.device.pwrite( header+images, self.start*bs )
+        self.sofs.device.sync()
+        cache.unpin(blocks)
+        cache.writeBack(blocks)
+        self.sofs.device.sync()
+        #the blocks are home: retire the transaction, so a later mount doesn't replay it over the unlogged
+        #writes made since (data in a freed block that was reused, the clean state set by close). The next sync writes it
+        self.sofs.device.pwrite( "\0"*bs, self.start*bs )
+        self.sequence+= 1
+        stats.counters["journal.commits"]+= 1
+        stats.counters["journal.blocks"]+= len(blocks)
+
+    def recover(self):
+        '''writes back the last committed transaction, if it is intact. Returns True if it did'''
+        bs= self.sofs.BLOCK_SIZE
+        device= self.sofs.device
+        transaction= self.readLog( device, self.start, self.nblocks, bs )
+        if transaction is None:
+            return False
+        blocks, images= transaction
+        count= len(blocks)
+        for i, block in enumerate(blocks):
+            device.pwrite( images[i*bs:(i+1)*bs], block*bs )
+        device.sync()
+        device.pwrite( "\0"*bs, self.start*bs )    #the log is now empty
+        device.sync()
+        log.info("replayed a journal transaction of {0} blocks".format(count))
+        return True
+
+    def commitEvery(self, interval):
+        '''starts a daemon thread that commits every interval seconds'''
+        def run():
+            while not self.failed:
+                time.sleep(interval)
+                try:
+                    self.commit()
+                except IOError:
+                    pass    #commit logged it, and the FS is now read-only
+        t= threading.Thread(target=run, name="sofs-journal")
+        t.daemon= True
+        t.start()
+
+
+class BlockCache:
+    '''size-bounded write-back LRU cache of whole device blocks'''
+    def __init__(self, device, block_size, capacity):
+        assert capacity > 0
+        self.device, self.block_size, self.capacity= device, block_size, capacity
+        self.blocks= collections.OrderedDict()  #block index -> bytearray, least recently used first
+        self.dirty= set()                       #indexes of blocks that differ from the device
+        self.pinned= set()                      #blocks that must not reach the device yet (see Journal)
+        self.lock= threading.RLock()
+
+    def _deviceRead(self, index, count=1):
+        size= count*self.block_size
+        stats.counters["device.reads"]+= 1
+        stats.counters["device.read_bytes"]+= size
+        data= self.device.pread( size, index*self.block_size )
+        if len(data) < size:
+            data+= "\0"*(size - len(data))   #past the end of the image
+        return data
+
+    def _deviceWrite(self, index, data):
+        stats.counters["device.writes"]+= 1
+        stats.counters["device.write_bytes"]+= len(data)
+        self.device.pwrite( data, index*self.block_size )
+
+    def _insert(self, index, data):
+        self.blocks[index]= data
+        while len(self.blocks) > self.capacity:
+            old_index= next( (i for i in self.blocks if i not in self.pinned and i!=index), None )
+            if old_index is None:
+                break   #everything else is pinned, grow until the journal commits
+            old_data= self.blocks.pop(old_index)
+            if old_index in self.dirty:
+                self._deviceWrite( old_index, str(old_data) )
+                self.dirty.discard( old_index )
+
+    def pin(self, indexes):
+        with self.lock:
+            self.pinned.update(indexes)
+
+    def unpin(self, indexes):
+        with self.lock:
+            self.pinned.difference_update(indexes)
+
+    def getBlock(self, index, overwrite=False):
+        '''returns the cached bytearray of a block, marking it most recently used.
+        overwrite: the caller will rewrite the whole block, so don't read it from the device'''
+        with self.lock:
+            data= self.blocks.pop(index, None)
+            if data is None:
+                data= bytearray(self.block_size) if overwrite else bytearray(self._deviceRead(index))
+            self._insert(index, data)
+            return data
+
+    def prefetch(self, indexes):
+        '''loads the given blocks, reading each run of consecutive missing blocks with a single device read'''
+        with self.lock:
+            indexes= [i for i in indexes if i not in self.blocks]
+            if len(indexes) > self.capacity/2:
+                indexes= indexes[:self.capacity/2]     #don't flush the whole cache for readahead
+            i= 0
+            while i < len(indexes):
+                j= i+1
+                while j < len(indexes) and indexes[j]==indexes[j-1]+1:
+                    j+= 1
+                data= self._deviceRead(indexes[i], j-i)
+                for k in xrange(i, j):
+                    self._insert( indexes[k], bytearray( data[(k-i)*self.block_size:(k-i+1)*self.block_size] ) )
+                i= j
+
+    def read(self, offset, size):
+        '''reads a byte range, loading each run of missing blocks with a single device read'''
+        first, last= offset/self.block_size, (offset+size-1)/self.block_size
+        parts= []
+        with self.lock:
+            i= first
+            while i <= last:
+                if i in self.blocks:
+                    parts.append( self.getBlock(i) )
+                    i+= 1
+                    continue
+                j= i
+                while j <= last and j not in self.blocks:
+                    j+= 1
+                data= self._deviceRead(i, j-i)
+                for k in xrange(i, j):
+                    block= bytearray( data[(k-i)*self.block_size:(k-i+1)*self.block_size] )
+                    self._insert(k, block)
+                    parts.append(block)
+                i= j
+        start= offset - first*self.block_size
+        if len(parts)==1:
+            return str( parts[0][start:start+size] )
+        return "".join( map(str, parts) )[start:start+size]
+
+    def write(self, offset, b):
+        written= 0
+        with self.lock:
+            while written < len(b):
+                index, block_offset= divmod(offset+written, self.block_size)
+                n= min(len(b)-written, self.block_size - block_offset)
+                data= self.getBlock(index, overwrite= n==self.block_size)
+                data[block_offset:block_offset+n]= b[written:written+n]
+                self.dirty.add(index)
+                written+= n
+
+    def flush(self):
+        '''writes every dirty block that is not pinned back to the device. Returns the number of blocks written'''
+        with self.lock:
+            return self.writeBack( self.dirty - self.pinned )
+
+    def writeBack(self, indexes):
+        '''writes the given dirty blocks back to the device, in block order, one write per run of consecutive blocks.
+        Returns the number of blocks written'''
+        with self.lock:
+            dirty= sorted( self.dirty.intersection(indexes) )
+            i= 0
+            while i < len(dirty):
+                j= i+1
+                while j < len(dirty) and dirty[j]==dirty[j-1]+1:
+                    j+= 1
+                self._deviceWrite( dirty[i], "".join( str(self.blocks[k]) for k in dirty[i:j] ) )
+                i= j
+            self.dirty.difference_update(dirty)
+            return len(dirty)
 
 
 class SofsFormat:
     INT_SIZE=   4
-    MAX_INODES= 122
-    def __init__(self, filename):
-        self.device= open(filename, 'r+')   #read-write
+    BLOCK_SIZES= [512<<i for i in range(8)]  #512 bytes to 64 KB
+    CACHE_BLOCKS= 1024  #default number of blocks kept in memory
+    INODE_CACHE_SIZE= 4096  #recently used inodes kept in memory, besides those in use
+    DEFAULT_BLOCK_SIZE= 4096    #block size of new FSs. Files reach MAX_FILE_SIZE, 2 GB, from 4 KB blocks on, and 8 MB with 512 byte blocks
+    JOURNAL_BLOCKS= 128 #size of a new journal, 1/32 of the FS, but at least Journal.MIN_BLOCKS on FSs with room for it
+    COPY_BLOCKS= 256    #blocks copied at a time by defragment
+    def __init__(self, filename, cache_blocks=CACHE_BLOCKS, use_mmap=False, journal=True, sparse=False, inline=True, prealloc=0):
+        '''
+        filename: the image file, or a device such as MemoryDevice (see FileDevice)
+        cache_blocks: size of the write-back block cache
+        use_mmap: map the image in memory instead of using the block cache. Needs a FileDevice
+        journal: log metadata changes (needs the block cache), creating the log if the FS has none
+        sparse: files grow with holes, and blocks are allocated when they are first written
+        inline: new files keep their bytes in the inode while they fit
+        prealloc: blocks reserved past the end of a file when a sequential write needs new blocks. They are freed
+            when the file's last handle is released, and at unmount (see INodeBlock.trimReserved)
+        '''
+        self.sparse, self.inline, self.prealloc= sparse, inline, prealloc
+        self.device= FileDevice(filename) if isinstance(filename, basestring) else filename
+        self.BLOCK_SIZE= self._readBlockSize()
+        self.map, self.cache= None, None
+        if use_mmap:
+            self.map= mmap.mmap( self.device.fd, 0 )
+        else:
+            self.cache= BlockCache( self.device, self.BLOCK_SIZE, cache_blocks )
+        self.lock= threading.RLock()    #held while changing the allocator, block 0 or the inode cache
+        self.inode_cache= collections.OrderedDict()    #block index -> INodeBlock, least recently used first
+        self.live_inodes= weakref.WeakValueDictionary()  #block index -> every INodeBlock in memory, so an inode has a single object
+        self.maintenance_lock= threading.Lock()  #held by background jobs while they change a file, and by close
+        self.closed= False
+        self.journal= Journal( self, None, 0 )  #disabled until the FS is checked
         self.zero_block= ZeroBlock( self )
-        
+        if self.zero_block.legacy:
+            self._convertFreeList()
+        self.info_block= InfoBlock( self, self.zero_block.info_block_index )
+        if self.info_block.features & InfoBlock.FEATURE_JOURNAL:
+            if Journal( self, self.info_block.journal_start, self.info_block.journal_blocks ).recover():
+                if self.cache is not None:
+                    self.cache= BlockCache( self.device, self.BLOCK_SIZE, cache_blocks )  #drop blocks read before the replay
+                self.zero_block= ZeroBlock( self )
+                self.info_block= InfoBlock( self, self.zero_block.info_block_index )
+        counted= self.info_block.features & InfoBlock.FEATURE_COUNTERS
+        clean= self.info_block.state!=InfoBlock.STATE_MOUNTED
+        #without a journal, or after a crash, the free count may not match the bits
+        trusted= counted and clean and self.info_block.features & InfoBlock.FEATURE_JOURNAL
+        self.bitmap= FreeBitmap( self, self.info_block.bitmap_start, self.info_block.bitmap_blocks, self.zero_block.block_count,
+                                 self.info_block.free_blocks if trusted else None )
+        if not self.info_block.features & InfoBlock.FEATURE_INDIRECT:
+            self._clearInodeTails()
+        if not self.info_block.features & InfoBlock.FEATURE_DIRS:
+            self._createRootDirectory()
+        self.root= self.getInodeBlock( self.info_block.root_dir )
+        if inline and not self.info_block.features & InfoBlock.FEATURE_INLINE:
+            self.info_block.addFeatures( InfoBlock.FEATURE_INLINE )
+        if not counted or not clean:
+            if counted:
+                log.warning("the FS was not unmounted cleanly, counting the free blocks and the inodes")
+            self.info_block.setCounters( self.bitmap.free_count, sum( 1 for _ in self.inodes() ) )
+        elif self.bitmap.free_count!=self.info_block.free_blocks:
+            self.info_block.setFreeBlocks( self.bitmap.free_count )
+        self.info_block.setMounted(True)
+        self.flush(sync=True)   #on the disk before any other change, so a crash is noticed
+        if journal and self.cache is not None:
+            if not self.info_block.features & InfoBlock.FEATURE_JOURNAL:
+                self._createJournal()
+            if self.info_block.features & InfoBlock.FEATURE_JOURNAL:
+                if self.info_block.journal_blocks < Journal.MIN_BLOCKS:
+                    log.warning("the journal is too small for large transactions, metadata changes will not be logged")
+                else:
+                    self.journal= Journal( self, self.info_block.journal_start, self.info_block.journal_blocks )
+
     def getBlock(self, x):
         return SofsBlock(self, x)
+
+    def _readBlockSize(self):
+        '''returns the block size recorded on block 0, which is needed to read any block'''
+        header= self.device.pread( 3*self.INT_SIZE, 0 )
+        block_size= struct.unpack_from('<i', header, 2*self.INT_SIZE)[0] if len(header)==3*self.INT_SIZE else None
+        if block_size not in self.BLOCK_SIZES:
+            e= IOError("Bad FS block size {0}".format(block_size))
+            e.errno= errno.EINVAL
+            raise e
+        return block_size
         
     def _writeBytes(self, index, b):
+        '''writes metadata, which is logged if a transaction is running'''
         #log.debug("write bytes to offset {0}: {1}".format(index, b))
-        self.device.seek(index)
-        self.device.write(b)
+        if self.journal.enabled:
+            self.journal.logWrite( index/self.BLOCK_SIZE, (index+len(b)-1)/self.BLOCK_SIZE )
+        self._writeData(index, b)
+
+    def _writeData(self, index, b):
+        '''writes file data, which is never logged'''
+        if self.map is not None:
+            stats.counters["device.writes"]+= 1
+            stats.counters["device.write_bytes"]+= len(b)
+            self.map[index:index+len(b)]= b
+        else:
+            self.cache.write(index, b)
         
     def _readBytes(self, index, size):
         #log.debug("reading {0} bytes from offset {1}".format(size, index))
-        self.device.seek(index)
-        return self.device.read(size)
+        if self.map is not None:
+            stats.counters["device.reads"]+= 1
+            stats.counters["device.read_bytes"]+= size
+            return self.map[index:index+size]
+        return self.cache.read(index, size)
+
+    def getView(self, index, size):
+        '''returns a view of size bytes at offset index.
+        The view is zero-copy unless it spans several cached blocks'''
+        if self.map is not None:
+            stats.counters["device.reads"]+= 1
+            stats.counters["device.read_bytes"]+= size
+            return _view( self.map, index, size )
+        block_index, block_offset= divmod(index, self.BLOCK_SIZE)
+        if block_offset+size > self.BLOCK_SIZE:
+            return self.cache.read(index, size)
+        return _view( self.cache.getBlock(block_index), block_offset, size )
+
+    def prefetch(self, indexes):
+        '''loads blocks in the block cache ahead of use. Does nothing in mmap mode'''
+        if self.cache is not None:
+            stats.counters["readahead.blocks"]+= len(indexes)
+            self.cache.prefetch(indexes)
+
+    def flush(self, sync=False):
+        '''writes pending changes to the device.
+        sync: also wait for them to reach the disk (mmap mode only does work when syncing)'''
+        self.journal.commit()
+        if self.map is not None:
+            if sync:
+                self.map.flush()
+        else:
+            self.cache.flush()
+            if sync:
+                self.device.sync()
+
+    def writeBack(self):
+        '''writes the dirty blocks that are not waiting for a journal commit back to the device, without syncing'''
+        if self.cache is not None:
+            self.cache.flush()
+
+    def syncData(self, indexes):
+        '''writes the given data blocks to the disk, so metadata written after them never points to stale data'''
+        if self.map is not None:
+            self.map.flush()
+        else:
+            self.cache.writeBack(indexes)
+            self.device.sync()
+
+    def close(self):
+        with self.maintenance_lock:
+            self.closed= True
+            if self.prealloc:
+                self.trimReserved()
+        self.flush(sync=True)   #commits and retires the last transaction, which must not be replayed over what follows
+        if not self.journal.failed:
+            self.info_block.setMounted(False)   #the counters can be trusted
+            self.flush(sync=True)
+        if self.map is not None:
+            self.map.close()
+        self.device.close()
+
+    def trimReserved(self):
+        '''frees the blocks that writes reserved past the end of the cached files (see INodeBlock.trimReserved)'''
+        for inode in self.live_inodes.values():
+            if inode.reserved!=IntTable.DEFAULT_VALUE and not inode.unlinked:
+                with inode.lock.writing():
+                    with self.journal.transaction():
+                        inode.trimReserved()
 
     def getInodeBlock(self, index):
-        log.debug("getting inode block "+str(index))
-        return INodeBlock(self, index)
+        if DEBUG:
+            log.debug("getting inode block "+str(index))
+        with self.lock:
+            inode= self.inode_cache.pop(index, None)
+            if inode is None:
+                #an inode dropped from the cache stays in memory while a handle, a lock holder or the
+                #attribute cache references it, and must not be decoded again
+                inode= self.live_inodes.get(index)
+            if inode is None:
+                inode= INodeBlock(self, index)
+                if inode.type==INodeBlock.TYPE_DIR:
+                    inode= DirectoryINode(self, index)
+                self.live_inodes[index]= inode
+            self.inode_cache[index]= inode     #most recently used
+            if len(self.inode_cache) > self.INODE_CACHE_SIZE:
+                self.inode_cache.popitem(last=False)
+        return inode
     
-    def getFreeBlock(self):
-        log.debug("getting free block")
-        i= self.zero_block.getFirstFreeBlockIndex()
-        log.debug("returning block "+str(i))
-        return FreeBlock(self, i)
-
-    def find(self, path):
-        '''returns the inodeBlock of a path'''
-        log.debug("executing find on "+path)
+    def _createJournal(self):
+        block_count= self.zero_block.block_count
+        nblocks= min( self.JOURNAL_BLOCKS, max( block_count/32, min( Journal.MIN_BLOCKS, block_count/8 ) ) )
+        if nblocks < Journal.MIN_BLOCKS or nblocks > self.bitmap.free_count:
+            log.warning("no space for a journal, metadata changes will not be logged")
+            return
+        blocks= self.bitmap.allocate(nblocks)
+        if blocks[-1]-blocks[0]!=nblocks-1:
+            self.bitmap.free(blocks)
+            log.warning("no contiguous space for a journal, metadata changes will not be logged")
+            return
+        self._writeBytes( blocks[0]*self.BLOCK_SIZE, "\0"*self.BLOCK_SIZE )   #empty header
+        self.info_block.setJournal( blocks[0], nblocks )
+        self.flush(sync=True)
+        log.info("created a journal of {0} blocks at block {1}".format(nblocks, blocks[0]))
+
+    def _clearInodeTails(self):
+        '''clears the ints after the data table of every inode, which older versions left uninitialized'''
+        for index in self.zero_block.inodes.readAllNonDefaultInts():
+            b= SofsBlock(self, index)
+            b.writeInts( b.TOTAL_INTS - INodeBlock.TAIL_INTS, (IntTable.DEFAULT_VALUE,)*INodeBlock.TAIL_INTS )
+        self.info_block.addFeatures( InfoBlock.FEATURE_INDIRECT )
+
+    def _createRootDirectory(self):
+        '''moves the files listed on block 0 to a new root directory'''
+        root= INodeBlock.allocateInodeBlock(self, "", directory=True)
         inodes= self.zero_block.inodes.readAllBlocks()
-        filename = os.path.basename(path)
         for inode in inodes:
-            if inode.getFilename()==filename:
-                log.debug("match on path of inode "+str(inode))
-                return inode
-        log.error("could not find path "+path)
-        raise CantFindInodeFromPath()
+            name= inode.getFilename()
+            try:
+                root.lookup(name)
+                name= "{0}.{1}".format(name[:50], inode.index)
+                log.warning("renaming duplicate file {0} to {1}".format(inode.getFilename(), name))
+                inode.setFilename(name)
+            except CantFindInodeFromPath:
+                pass
+            root.add(name, inode.index)
+        self.flush(sync=True)
+        self.info_block.setRootDirectory( root.index )
+        self.flush(sync=True)
+        table= self.zero_block.inodes
+        table.writeInts( 0, (IntTable.DEFAULT_VALUE,)*table.size )
+        log.info("moved {0} files to a root directory at block {1}".format(len(inodes), root.index))
+
+    def _convertFreeList(self):
+        '''replaces the legacy free list with a free block bitmap'''
+        block_count= self.zero_block.block_count
+        free, i= set(), self.zero_block.free_list_head
+        while i!=-1:
+            if i in free or not 0 < i < block_count:
+                log.warning("free list is broken at block {0}, stopping there".format(i))
+                break
+            free.add(i)
+            i= FreeBlock(self, i).getNextFreeBlockIndex()
+        #the bitmap needs a contiguous run of blocks, the InfoBlock any other block
+        nbitmap= FreeBitmap.blocksNeeded( block_count, self.BLOCK_SIZE )
+        ordered= sorted(free)
+        bitmap_start= None
+        for j in xrange(len(ordered)-nbitmap+1):
+            if ordered[j+nbitmap-1]-ordered[j]==nbitmap-1:
+                bitmap_start= ordered[j]
+                break
+        if bitmap_start is None:
+            e= IOError("Not enough free space to convert the free list to a bitmap")
+            e.errno= errno.ENOSPC
+            raise e
+        used= set(xrange(bitmap_start, bitmap_start+nbitmap))
+        info_index= min(free - used)
+        used.add(info_index)
+        free-= used
+        bits= bytearray("\xff"*(nbitmap*self.BLOCK_SIZE))
+        for i in free:
+            bits[i>>3]&= ~(1<<(i&7))
+        self._writeBytes( bitmap_start*self.BLOCK_SIZE, str(bits) )
+        InfoBlock.initialize( self, info_index, bitmap_start, nbitmap )
+        self.zero_block.setInfoBlockIndex( info_index )     #last, so an interrupted conversion leaves a valid legacy FS
+        log.info("converted free list of {0} blocks to a bitmap at block {1}".format(len(free), bitmap_start))
+
+    def inodes(self):
+        '''yields every file and directory, from the root down'''
+        stack= [self.root]
+        while stack:
+            inode= stack.pop()
+            yield inode
+            if isinstance(inode, DirectoryINode):
+                stack.extend( child for _, child in inode.children() )
+
+    def defragment(self, move=True):
+        '''moves the data blocks of each fragmented file to a contiguous run. Can run on a mounted FS,
+        as each file is locked while it moves. Returns fragmentation statistics before and after the pass.
+        move: False to only measure the fragmentation'''
+        result= {"files": 0, "blocks": 0, "moved_blocks": 0, "skipped_files": 0,
+                 "before": collections.Counter(), "after": collections.Counter()}
+        for inode in self.inodes():
+            if isinstance(inode, DirectoryINode):
+                continue
+            with self.maintenance_lock:
+                if self.closed:
+                    break
+                with inode.lock.writing():
+                    if inode.unlinked:
+                        continue
+                    fragments= inode.block_map.fragments()
+                    moved= inode.defragment() if move and fragments > 1 else 0
+                    if moved is None:
+                        result["skipped_files"]+= 1     #no free run large enough
+                    result["files"]+= 1
+                    result["blocks"]+= inode.block_map.allocatedBlocks()
+                    result["moved_blocks"]+= moved or 0
+                    for key, n in (("before", fragments), ("after", inode.block_map.fragments())):
+                        result[key]["extents"]+= n
+                        result[key]["fragmented_files"]+= n > 1
+        for key in ("before", "after"):
+            result[key]= dict(result[key], extents_per_file= float(result[key]["extents"])/result["files"] if result["files"] else None)
+        stats.counters["defrag.moved_blocks"]+= result["moved_blocks"]
+        return result
+
+    def defragmentEvery(self, interval):
+        '''starts a daemon thread that runs a defragmentation pass every interval seconds'''
+        def run():
+            while not self.closed:
+                time.sleep(interval)
+                result= self.defragment()
+                log.info("defragmented: {0}".format(json.dumps(result, sort_keys=True)))
+        t= threading.Thread(target=run, name="sofs-defrag")
+        t.daemon= True
+        t.start()
+
+    @_timed("find")
+    def find(self, path):
+        '''returns the inodeBlock of a path, looking up each component in its directory'''
+        inode= self.root
+        for name in path.split("/"):
+            if not name:
+                continue
+            if not isinstance(inode, DirectoryINode):
+                stats.counters["find.miss"]+= 1
+                raise CantFindInodeFromPath()
+            with inode.lock.reading():
+                try:
+                    index= inode.lookup(name)
+                except CantFindInodeFromPath:
+                    stats.counters["find.miss"]+= 1
+                    if DEBUG:
+                        log.debug("could not find path "+path)
+                    raise
+            inode= self.getInodeBlock(index)
+        stats.counters["find.hit"]+= 1
+        return inode
 
 
 
+def mkfs(filename, block_count, block_size=SofsFormat.DEFAULT_BLOCK_SIZE, journal=True):
+    '''creates an empty SoFS image. The image is sparse: only block 0, the InfoBlock and the bitmap
+    are written, and mounting it once adds the root directory and the journal.
+    filename may also be a device (see FileDevice) of at least block_count blocks'''
+    if block_size not in SofsFormat.BLOCK_SIZES:
+        e= IOError("Bad FS block size {0}".format(block_size))
+        e.errno= errno.EINVAL
+        raise e
+    ints= block_size/SofsFormat.INT_SIZE
+    nbitmap= FreeBitmap.blocksNeeded( block_count, block_size )
+    used= 2 + nbitmap   #block 0, InfoBlock, bitmap
+    if not used + 2 <= block_count < 2**31:   #the root directory needs two blocks
+        e= IOError("Bad FS block count {0}".format(block_count))
+        e.errno= errno.EINVAL
+        raise e
+    zero= _intStruct(5).pack( ZeroBlock.MAGIC_1, ZeroBlock.MAGIC_2_BITMAP, block_size, block_count, 1 )
+    zero+= "\xff"*(block_size - len(zero))     #empty inode table
+    info= _intStruct(4).pack( InfoBlock.MAGIC, InfoBlock.FEATURE_BITMAP | InfoBlock.FEATURE_INDIRECT, 2, nbitmap )
+    info+= "\xff"*(block_size - len(info))     #unused fields are -1
+    #the used blocks and the padding after the last block are set
+    bits= bytearray( nbitmap*block_size )
+    bits[:used>>3]= "\xff"*(used>>3)
+    for i in range(used & ~7, used) + range(block_count, min(nbitmap*block_size*8, (block_count+7) & ~7)):
+        bits[i>>3]|= 1<<(i&7)
+    bits[(block_count+7)>>3:]= "\xff"*(len(bits) - ((block_count+7)>>3))
+    if isinstance(filename, basestring):
+        fd= os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate( fd, block_count*block_size )
+            _pwrite( fd, zero + info + str(bits), 0 )
+        finally:
+            os.close(fd)
+    else:
+        filename.pwrite( zero + info + str(bits), 0 )
+    SofsFormat( filename, journal=journal ).close()
+
+
+class AttrCache:
+    '''remembers the inodes of recently looked up paths, and the paths that don't exist.
+    Attributes are read from the cached inode, which is always current, so only changes to the
+    directory tree invalidate entries'''
+    def __init__(self, capacity):
+        self.capacity= capacity
+        self.entries= collections.OrderedDict()    #path -> INodeBlock, or None if the path doesn't exist
+        self.lock= threading.Lock()
+        self.generation= 0  #changes on every invalidation, so lookups that raced with one are not stored
+
+    def get(self, path):
+        '''returns (found, inode). inode is None for a path that doesn't exist'''
+        with self.lock:
+            inode= self.entries.pop(path, self)
+            if inode is self:
+                stats.counters["attr_cache.miss"]+= 1
+                return False, None
+            self.entries[path]= inode  #most recently used
+        stats.counters["attr_cache.hit" if inode is not None else "attr_cache.negative_hit"]+= 1
+        return True, inode
+
+    def put(self, path, inode, generation):
+        '''stores the result of a lookup that started at generation'''
+        with self.lock:
+            if generation!=self.generation:
+                return
+            self.entries.pop(path, None)
+            self.entries[path]= inode
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, subtree=False):
+        '''forgets path and its parent directory, whose size may change, and every path under it if subtree.
+        Called once the change is done, so the lookups it raced with are either dropped or not stored'''
+        with self.lock:
+            self.generation+= 1
+            self.entries.pop(path, None)
+            self.entries.pop(os.path.dirname(path), None)
+            if subtree:
+                prefix= path.rstrip("/")+"/"
+                for p in [p for p in self.entries if p.startswith(prefix)]:
+                    del self.entries[p]
+
+
+class SofsFile(object):
+    '''an open file. fuse-python creates one on open and create (see SoFS.file_class),
+    and I/O on it uses the inode resolved at open instead of looking up the path again'''
+    READAHEAD_MIN, READAHEAD_MAX= 8, 256    #readahead window, in blocks
+    fs= None    #the SoFS, set on the subclass made by SoFS.__init__
+
+    def __init__(self, path, flags, *mode):
+        fs= self.fs
+        if flags & os.O_CREAT:
+            with fs.namespace_lock:
+                try:
+                    fs.format.find(path)
+                    if flags & os.O_EXCL:
+                        e= OSError("File exists")
+                        e.errno= errno.EEXIST
+                        raise e
+                except CantFindInodeFromPath:
+                    fs._create(path)
+        try:
+            self.inode= fs.format.find(path)
+        except CantFindInodeFromPath:
+            e= OSError("Couldn't find the given path")
+            e.errno= errno.ENOENT
+            raise e
+        #readahead state: where a sequential read would continue, the window size and the first block not prefetched
+        self.ra_next, self.ra_window, self.ra_until= 0, 0, 0
+        with self.inode.lock.writing():
+            self.inode.opened+= 1
+        if flags & os.O_TRUNC:
+            self.ftruncate(0)
+
+    @contextlib.contextmanager
+    def _locked(self, write=False):
+        '''holds the inode lock for reading or writing'''
+        with (self.inode.lock.writing() if write else self.inode.lock.reading()):
+            if self.inode.unlinked:
+                e= IOError("File was unlinked")
+                e.errno= errno.ESTALE
+                raise e
+            yield self.inode
+
+    @_operation
+    def read(self, length, offset):
+        with self._locked() as f:
+            buf= f.readFile(length, offset)
+            self._readahead(f, offset, len(buf))
+        return buf
+
+    def _readahead(self, f, offset, length):
+        '''called after a read. If reads are sequential, prefetches the blocks that follow
+        into the block cache, doubling the window while the stream goes on'''
+        end= offset+length
+        if offset!=self.ra_next:
+            self.ra_next, self.ra_window, self.ra_until= end, 0, 0
+            return
+        self.ra_next= end
+        end_block= (end + f.BLOCK_SIZE - 1)/f.BLOCK_SIZE
+        if self.ra_until - end_block > self.ra_window/2:
+            return  #still far enough ahead
+        self.ra_window= min( max(self.ra_window*2, self.READAHEAD_MIN), self.READAHEAD_MAX )
+        start= max(end_block, self.ra_until)
+        stop= min(end_block + self.ra_window, len(f.block_map), f.needed_blocks(f.size))   #not the blocks reserved past the end
+        if start < stop:
+            f.sofs.prefetch( [i for i in f.block_map.map[start:stop] if i!=IntTable.DEFAULT_VALUE] )
+        self.ra_until= stop
+
+    @_operation
+    def write(self, buf, offset):
+        try:
+            with self._locked(write=True) as f:
+                with self.fs.format.journal.transaction():
+                    f.writeFile(buf, offset)
+        except NoFreeBlocks:
+            e=IOError("No space left on device")
+            e.errno= errno.ENOSPC
+            raise e
+        return len(buf)
+
+    @_operation
+    def ftruncate(self, size):
+        try:
+            with self._locked(write=True) as f:
+                with self.fs.format.journal.transaction():
+                    f.setSize(size)
+        except NoFreeBlocks:
+            e=IOError("No space left on device")
+            e.errno= errno.ENOSPC
+            raise e
+
+    @_operation
+    def fallocate(self, mode, offset, length):
+        with self._locked(write=True) as f:
+            self.fs._fallocate(f, mode, offset, length)
+
+    @_operation
+    def fgetattr(self):
+        with self._locked() as f:
+            return self.fs._stat(f)
+
+    @_operation
+    def flush(self):
+        return 0
+
+    @_operation
+    def release(self, flags):
+        f= self.inode
+        with f.lock.writing():
+            f.opened-= 1
+            if not f.opened and not f.unlinked and f.reserved!=IntTable.DEFAULT_VALUE:
+                with self.fs.format.journal.transaction():
+                    f.trimReserved()    #the blocks writes reserved ahead
+        self.fs.format.writeBack()  #metadata is committed on fsync, by the commit thread, and when the log fills up
+        return 0
+
+    @_operation
+    def fsync(self, isFsyncFile):
+        self.fs.format.flush(sync=True)
+
+
 class SoFS(fuse.Fuse):
+    ATTR_CACHE_SIZE= 4096   #paths remembered by getattr
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
         self.device= None   #device path, will be set outside
+        self.cache= None    #number of cached blocks, will be set outside
+        self.backend= None  #"file", "mmap" or "ram", will be set outside
+        self.latency= None  #microseconds added to each device operation, will be set outside
+        self.sparse= None
+        self.prealloc= None
         self.format= None   #SofsFormat,  will be set outside
+        self.stats= None    #file where statistics are dumped on SIGUSR1 and unmount, will be set outside
+        self.debug_log= None
+        self.commit= None   #seconds between journal commits, will be set outside
+        self.defrag= None   #seconds between background defragmentation passes, will be set outside
+        self.journal= None
+        self.namespace_lock= threading.Lock()   #held by operations that add or remove directory entries, so they are serialized
+        self.attr_cache= AttrCache( self.ATTR_CACHE_SIZE )
+        self.file_class= type("SofsFile", (SofsFile,), {"fs": self})
+
+    @contextlib.contextmanager
+    def _inode(self, path, write=False):
+        '''finds the inode of path and holds its lock for reading or writing'''
+        while True:
+            inode= self.format.find(path)
+            with (inode.lock.writing() if write else inode.lock.reading()):
+                if not inode.unlinked:     #else it was unlinked while we waited for the lock
+                    yield inode
+                    return
 
-    def getattr(self, path):
-        log.debug("called getattr {0}".format(path))
+    def _stat(self, inode):
+        '''returns the fuse.Stat of a file or directory'''
         st = fuse.Stat()
         st.st_mode = 0755 | stat.S_IFREG
         st.st_nlink = 1
@@ -427,97 +2341,303 @@ class SoFS(fuse.Fuse):
         st.st_mtime = 0.0
         st.st_ctime = 0.0
 
-        if os.path.abspath(path)=="/":
+        if isinstance(inode, DirectoryINode):
             st.st_mode = 0755 | stat.S_IFDIR
-            return st
+            st.st_nlink = 2
+        st.st_size= inode.getSize()
+        st.st_blksize= self.format.BLOCK_SIZE
+        st.st_blocks= inode.block_map.allocatedBlocks() * self.format.BLOCK_SIZE / 512   #in 512 byte units
+        return st
+
+    @_operation
+    def getattr(self, path):
+        path= os.path.normpath(path)
+        found, inode= self.attr_cache.get(path)
+        while True:
+            if not found:
+                generation= self.attr_cache.generation
+                try:
+                    inode= self.format.find(path)
+                except CantFindInodeFromPath:
+                    inode= None
+                self.attr_cache.put(path, inode, generation)
+            if inode is None:
+                e= OSError("Couldn't find the given path")
+                e.errno= errno.ENOENT
+                raise e
+            with inode.lock.reading():
+                if not inode.unlinked:
+                    return self._stat(inode)
+            found= False    #unlinked since it was cached: look it up again
+
+    @_operation
+    def statfs(self):
+        '''returns the fuse.StatVfs of the FS, from counters kept in memory'''
+        bitmap= self.format.bitmap
+        st= fuse.StatVfs()
+        st.f_bsize= st.f_frsize= self.format.BLOCK_SIZE
+        st.f_blocks= bitmap.block_count
+        st.f_bfree= st.f_bavail= bitmap.free_count
+        #any free block can become an inode
+        st.f_files= self.format.info_block.inode_count + bitmap.free_count
+        st.f_ffree= st.f_favail= bitmap.free_count
+        st.f_namemax= 63
+        return st
+
+    def _directory(self, path):
+        '''returns the DirectoryINode of path'''
         try:
             inode= self.format.find(path)
-            st.st_size= inode.getSize()
-            st.st_blksize= 512
-            st.st_blocks=inode.needed_blocks( inode.getSize() )
-            return st
         except CantFindInodeFromPath:
             e= OSError("Couldn't find the given path")
             e.errno= errno.ENOENT
             raise e
-    
-    def write(self, path, buf, offset):
-        log.debug("called write {0} {1} {2}".format(path, buf, offset))
-        f = self.format.find(path)
-        try:
-            f.writeFile(buf, offset)
-        except NoFreeBlocks:
-            e=IOError("Couldn't find the given path")
-            e.errno= errno.ENOSPC
+        if not isinstance(inode, DirectoryINode):
+            e= OSError("Not a directory")
+            e.errno= errno.ENOTDIR
             raise e
-        return len(buf)
-    
-    def read(self, path, length, offset):
-        log.debug("called read {0} {1} {2}".format(path, length, offset))
-        f = self.format.find(path)
-        buf = f.readFile(length,offset)
-        return buf
-    
-    def open( self, path, flags ):
-        log.debug("called open {0} {1}".format(path, flags))
-        return 0
-    
-    def flush(self, path):
-        log.debug("called close {0}".format(path))
-        return 0
-        
-    def release(self, path, flags):
-        log.debug("called close {0} {1}".format(path, flags))
-        return 0
+        return inode
 
+    def _parent(self, path):
+        '''returns the DirectoryINode holding path, and the name of path in it'''
+        path= os.path.normpath(path)
+        return self._directory( os.path.dirname(path) ), os.path.basename(path)
+
+    @_operation
     def readdir(self, path, offset):
-        log.debug("called readdir {0} {1}".format(path, offset))
-        filenames= [".",".."]
-        filenames.extend( [i.filename for i in self.format.zero_block.inodes.readAllBlocks()] )
-        for fn in filenames:
+        directory= self._directory(path)
+        yield fuse.Direntry(".")
+        yield fuse.Direntry("..")
+        for fn in directory.names():
             yield fuse.Direntry( fn )
 
-    def create(self, path, flags, mode):
-        log.debug("called create "+path)
-        filename = os.path.basename(path)
+    def _create(self, path, directory=False):
+        '''creates an empty file or directory. Called with namespace_lock held, by mkdir and by
+        SofsFile, which fuse-python uses for the create operation'''
+        parent, filename = self._parent(path)
         try:
-            INodeBlock.allocateInodeBlock(self.format, filename)
+            with parent.lock.writing():
+                with self.format.journal.transaction():
+                    #the inode, and the bucket of a directory
+                    if parent.addBlocks(filename) + (2 if directory else 1) > self.format.bitmap.free_count:
+                        raise NoFreeBlocks()
+                    inode= INodeBlock.allocateInodeBlock(self.format, filename, directory)
+                    try:
+                        parent.add(filename, inode.index)
+                    except NoFreeBlocks:
+                        inode.unlink()  #blocks were taken since the check
+                        raise
         except NoFreeBlocks:
-            e=IOError("Couldn't find the given path")
+            e=IOError("No space left on device")
             e.errno= errno.ENOSPC
             raise e
-        
+        finally:
+            #after the change (see AttrCache.invalidate)
+            self.attr_cache.invalidate( os.path.normpath(path) )
+
+    @_operation
+    def mkdir(self, path, mode):
+        with self.namespace_lock:
+            try:
+                self.format.find(path)
+                e= OSError("File exists")
+                e.errno= errno.EEXIST
+                raise e
+            except CantFindInodeFromPath:
+                self._create(path, directory=True)
+
+    @_operation
     def rename(self, pathfrom, pathto):
-        inode= self.format.find(os.path.basename(pathfrom))
-        inode.setFilename(os.path.basename(pathto))
+        pathfrom, pathto= os.path.normpath(pathfrom), os.path.normpath(pathto)
+        with self.namespace_lock:
+            from_parent, from_name= self._parent(pathfrom)
+            to_parent, to_name= self._parent(pathto)
+            try:
+                inode= self.format.find(pathfrom)
+            except CantFindInodeFromPath:
+                e= OSError("Couldn't find the given path")
+                e.errno= errno.ENOENT
+                raise e
+            try:
+                target= self.format.find(pathto)
+            except CantFindInodeFromPath:
+                target= None
+            if target is inode:
+                return
+            is_dir= isinstance(inode, DirectoryINode)
+            if is_dir and pathto.startswith(pathfrom+"/"):
+                e= OSError("Can't move a directory into itself")
+                e.errno= errno.EINVAL
+                raise e
+            if target is not None:
+                if isinstance(target, DirectoryINode)!=is_dir:
+                    e= OSError("Can't replace a directory with a file, or a file with a directory")
+                    e.errno= errno.ENOTDIR if is_dir else errno.EISDIR
+                    raise e
+                if is_dir and target.entries:
+                    e= OSError("Directory not empty")
+                    e.errno= errno.ENOTEMPTY
+                    raise e
+            locked= []
+            for i in (inode, target, from_parent, to_parent):
+                if i is not None and i not in locked:
+                    locked.append(i)
+            try:
+                #transactions start after every inode lock is held, or they could wait for a lock while a commit waits for them
+                with contextlib.nested( *[i.lock.writing() for i in locked] ):
+                    with self.format.journal.transaction():
+                        if target is not None:
+                            target.unlink()     #rename replaces an existing target
+                            to_parent.remove(to_name)   #frees its slot, so adding the entry back allocates nothing
+                        try:
+                            #add changes nothing if it fails, and the old entry is removed after it, so
+                            #running out of space leaves the file where it was
+                            to_parent.add(to_name, inode.index)
+                        except NoFreeBlocks:
+                            e= OSError("No space left on device")
+                            e.errno= errno.ENOSPC
+                            raise e
+                        from_parent.remove(from_name)
+                        inode.setFilename(to_name)
+            finally:
+                self.attr_cache.invalidate(pathfrom, subtree=True)
+                self.attr_cache.invalidate(pathto, subtree=True)
+
+    def _remove(self, path, directory):
+        '''removes a file, or an empty directory'''
+        with self.namespace_lock:
+            parent, name= self._parent(path)
+            try:
+                with self._inode(path, write=True) as inode:
+                    if isinstance(inode, DirectoryINode)!=directory:
+                        e= OSError("Is a directory" if not directory else "Not a directory")
+                        e.errno= errno.ENOTDIR if directory else errno.EISDIR
+                        raise e
+                    if inode is self.format.root:
+                        e= OSError("Can't remove the root directory")
+                        e.errno= errno.EBUSY
+                        raise e
+                    if directory and inode.entries:
+                        e= OSError("Directory not empty")
+                        e.errno= errno.ENOTEMPTY
+                        raise e
+                    try:
+                        with parent.lock.writing():
+                            with self.format.journal.transaction():
+                                inode.unlink()
+                                parent.remove(name)
+                    finally:
+                        self.attr_cache.invalidate( os.path.normpath(path) )
+            except CantFindInodeFromPath:
+                e= OSError("Couldn't find the given path")
+                e.errno= errno.ENOENT
+                raise e
+
+    @_operation
+    def unlink ( self, path ):
+        self._remove(path, directory=False)
 
+    @_operation
+    def rmdir ( self, path ):
+        self._remove(path, directory=True)
 
+    @_operation
     def utime ( self, path, times ):
         pass # can't do anything, since we don't have data structures for times on disk
 
-    def unlink ( self, path ):
-        log.debug("called unlink "+path)
-        inode= self.format.find(path)
-        inode.unlink()
-
+    @_operation
     def chmod ( self, path, mode ):
         pass    #can't do without data structures
 
+    @_operation
     def chown ( self, path, uid, gid ):
         pass    #can't do without data structures
 
-    def fsync ( self, path, isFsyncFile ):
-        pass    #no need, for now
+    def fsinit ( self ):
+        if self.commit:
+            self.format.journal.commitEvery( float(self.commit) )
+        if self.defrag:
+            self.format.defragmentEvery( float(self.defrag) )
 
+    def fsdestroy ( self ):
+        self.format.close()
+        self.dumpStats()
+
+    def dumpStats(self, *args):
+        '''writes the statistics to the stats file, if any. Also used as the SIGUSR1 handler'''
+        if self.stats:
+            stats.dump( self.stats )
+
+    @_operation
     def truncate ( self, path, size ):
-        log.debug("called truncate {0} {1}".format(path, size))
-        inode = self.format.find(path)
-        inode.setSize(size)
+        with self._inode(path, write=True) as inode:
+            if isinstance(inode, DirectoryINode):
+                e= IOError("Is a directory")
+                e.errno= errno.EISDIR
+                raise e
+            try:
+                with self.format.journal.transaction():
+                    inode.setSize(size)
+            except NoFreeBlocks:
+                e=IOError("No space left on device")
+                e.errno= errno.ENOSPC
+                raise e
+
+    def _fallocate(self, inode, mode, offset, length):
+        '''allocates file bytes [offset, offset+length). The caller holds the inode lock for writing'''
+        if mode & ~FALLOC_FL_KEEP_SIZE:
+            e= IOError("Only space reservation is supported")
+            e.errno= errno.EOPNOTSUPP
+            raise e
+        if offset < 0 or length <= 0:
+            e= IOError("Invalid range")
+            e.errno= errno.EINVAL
+            raise e
+        try:
+            with self.format.journal.transaction():
+                inode.preallocate( offset, length, keep_size= bool(mode & FALLOC_FL_KEEP_SIZE) )
+        except NoFreeBlocks:
+            e=IOError("No space left on device")
+            e.errno= errno.ENOSPC
+            raise e
+
+    @_operation
+    def fallocate ( self, path, mode, offset, length ):
+        with self._inode(path, write=True) as inode:
+            if isinstance(inode, DirectoryINode):
+                e= IOError("Is a directory")
+                e.errno= errno.EISDIR
+                raise e
+            self._fallocate(inode, mode, offset, length)
         
 if __name__ == '__main__':
     fs = SoFS()
     fs.multithreaded = 0
     fs.parser.add_option(mountopt="device", metavar="DEVICE", help="device file")
+    fs.parser.add_option(mountopt="stats", metavar="FILE", default="sofs.stats.json", help="where statistics are dumped on SIGUSR1 and unmount")
+    fs.parser.add_option(mountopt="debug_log", metavar="BOOL", help="log every operation and metadata write (slow)")
+    fs.parser.add_option(mountopt="commit", metavar="SECONDS", default="5", help="interval between journal commits")
+    fs.parser.add_option(mountopt="journal", metavar="BOOL", default="1", help="log metadata changes")
+    fs.parser.add_option(mountopt="sparse", metavar="BOOL", help="leave unwritten blocks as holes (default 0)")
+    fs.parser.add_option(mountopt="inline", metavar="BOOL", default="1", help="keep the bytes of small new files in their inode")
+    fs.parser.add_option(mountopt="prealloc", metavar="BLOCKS", help="blocks reserved ahead of files written sequentially (default 0)")
+    fs.parser.add_option(mountopt="multithreaded", metavar="BOOL", help="serve requests from several threads (default 0)")
+    fs.parser.add_option(mountopt="cache", metavar="BLOCKS", help="number of blocks kept in the write-back cache")
+    fs.parser.add_option(mountopt="backend", metavar="BACKEND", help="device access: file (default), mmap, or ram (a copy of the device in memory, discarded on unmount)")
+    fs.parser.add_option(mountopt="defrag", metavar="SECONDS", help="defragment files in the background every SECONDS (default never)")
+    fs.parser.add_option(mountopt="latency", metavar="MICROSECONDS", help="delay every device read and write, to simulate slow storage (not with mmap)")
     tmp= fs.parse(values=fs, errex=1)
-    fs.format= SofsFormat( fs.device )
+    for option, value in (("entry_timeout", "1"), ("attr_timeout", "1"), ("negative_timeout", "1")):
+        #every change goes through this mount, so the kernel can cache names, attributes and missing names too
+        if option not in fs.fuse_args.optdict:
+            fs.fuse_args.add(option, value)
+    fs.multithreaded= str(fs.multithreaded).lower() in ("1", "yes", "true")
+    setDebugLogging( str(fs.debug_log).lower() in ("1", "yes", "true") )
+    signal.signal( signal.SIGUSR1, fs.dumpStats )
+    device= MemoryDevice.fromFile(fs.device) if fs.backend=="ram" else FileDevice(fs.device)
+    if fs.latency and fs.backend!="mmap":
+        device= LatencyDevice( device, float(fs.latency)/1e6, float(fs.latency)/1e6 )
+    fs.format= SofsFormat( device, cache_blocks=int(fs.cache or SofsFormat.CACHE_BLOCKS), use_mmap= fs.backend=="mmap",
+                           journal= str(fs.journal).lower() in ("1", "yes", "true"), sparse= str(fs.sparse).lower() in ("1", "yes", "true"),
+                           inline= str(fs.inline).lower() in ("1", "yes", "true"), prealloc= int(fs.prealloc or 0) )
     fs.main()
@@ -1,4 +1,8 @@
-import sys, os, random, string
+import sys, os, random, string, errno, time
+
+#the expected values are for a new image made with "./mkfs.py -s 200 -b 512 -f disk.img", mounted
+#with the default options on mountpoint (see run_in_foreground.sh). Run each test on a new image.
+#remount_test needs a journal, which a 200 block image has no room for: use "./mkfs.py -s 1000 -b 512 -f disk.img"
 
 class Test():
     def __init__(self, name, runtest):
@@ -24,29 +28,29 @@ def maxInodesTest():
     print "Will try to create 200 files"
     number_of_files=0
     for i in range(0,200):
-        filename = ''.join(random.choice(string.ascii_uppercase) for x in range(10))
+        filename = "file%03d" % i  #the directory layout, and so the blocks it uses, depends on the names
         try:
             f= open('mountpoint/'+filename, 'w')
             f.close()
         except(IOError):
             number_of_files=i
             break
-    if number_of_files != 123:
+    if number_of_files != 164:
         raise Exception("Number of files created diferent from what's expected : "+str(number_of_files))
 
 def maxBlocksTest():
     print "Will try to create enough files to a fill the whole disk"
     number_of_files=0
     for i in range(1,300):
-        filename = ''.join(random.choice(string.ascii_uppercase) for x in range(10))
+        filename = "file%03d" % i
         try:
             f= open('mountpoint/'+filename, 'w')
-            f.write("something to fill a data block")
+            f.write("something to fill a data block".ljust(512, "."))   #smaller files are kept in the inode
             f.close()
         except(IOError):
             number_of_files=i-1
             break
-    if number_of_files != 99:
+    if number_of_files != 89:
         raise Exception("Number of files created diferent from what's expected : "+str(number_of_files))
 
 def maxFileSizeTest():
@@ -63,11 +67,101 @@ def maxFileSizeTest():
             #import pdb;pdb.set_trace()
             data_blocks=i
             break
-    if data_blocks != 110:
+    if data_blocks != 193:
         raise Exception("Number of data blocks alocated diferent from what's expected : "+str(data_blocks))
+    #the image is too small for the largest file, but writing past it must fail
+    max_size = 512*(100 + 128 + 128**2)
+    try:
+        f= open('mountpoint/max_file', 'r+')
+        f.seek(max_size)
+        f.write("x")
+        f.close()
+    except(IOError) as e:
+        if e.errno != errno.EFBIG:
+            raise
+    else:
+        raise Exception("Could write past the largest file size")
+
+def directoriesTest():
+    print "Will create, list, rename and remove directories"
+    os.makedirs('mountpoint/a/b/c')
+    for i in range(50):
+        open('mountpoint/a/b/c/file%03d' % i, 'w').close()
+    if sorted(os.listdir('mountpoint/a/b/c')) != ["file%03d" % i for i in range(50)]:
+        raise Exception("Listed diferent files from the ones created")
+    os.rename('mountpoint/a/b/c/file000', 'mountpoint/a/moved')
+    if not os.path.isfile('mountpoint/a/moved') or os.path.exists('mountpoint/a/b/c/file000'):
+        raise Exception("Rename didn't move the file")
+    try:
+        os.rmdir('mountpoint/a/b/c')
+        raise Exception("Removed a directory that isn't empty")
+    except(OSError) as e:
+        if e.errno != errno.ENOTEMPTY:
+            raise
+    for name in os.listdir('mountpoint/a/b/c'):
+        os.remove('mountpoint/a/b/c/'+name)
+    os.rmdir('mountpoint/a/b/c')
+    if os.listdir('mountpoint/a/b') != []:
+        raise Exception("The removed directory is still listed")
+
+def inlineTest():
+    print "Will check that small files don't use data blocks"
+    data = os.urandom(300)
+    f= open('mountpoint/small', 'w')
+    f.write(data)
+    f.close()
+    if os.stat('mountpoint/small').st_blocks != 0:
+        raise Exception("A small file uses data blocks")
+    f= open('mountpoint/small', 'a')
+    f.write(data)
+    f.close()
+    if os.stat('mountpoint/small').st_blocks == 0 or open('mountpoint/small').read() != data+data:
+        raise Exception("The file didn't grow into data blocks")
+
+def statfsTest():
+    print "Will check that the free space reported follows writes and removals"
+    free = os.statvfs('mountpoint').f_bfree
+    f= open('mountpoint/big', 'w')
+    f.write("x"*512*10)
+    f.close()
+    used = free - os.statvfs('mountpoint').f_bfree
+    if used != 11:  #the inode and the data blocks
+        raise Exception("Free blocks diferent from what's expected : "+str(used))
+    os.remove('mountpoint/big')
+    if os.statvfs('mountpoint').f_bfree != free:
+        raise Exception("The blocks of a removed file were not freed")
+
+def remount():
+    if os.system("fusermount -u mountpoint") != 0:
+        raise Exception("Couldn't unmount the FS")
+    time.sleep(1)   #the FS writes its last changes as it exits
+    if os.system("./sofs.py mountpoint -o device=disk.img") != 0:
+        raise Exception("Couldn't mount the FS again")
+
+def remountTest():
+    print "Will check that a clean unmount leaves no journal transaction to replay"
+    f= open('mountpoint/a', 'w')
+    f.write("a"*512*120)    #uses an indirect block
+    f.close()
+    open('mountpoint/a', 'w').close()   #frees it, and b may reuse it for data
+    f= open('mountpoint/b', 'w')
+    f.write("1"*512*40)
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(0)
+    f.write("2"*512*40)
+    f.close()
+    remount()
+    if open('mountpoint/b').read() != "2"*512*40:
+        raise Exception("The remount undid writes made after a journal commit")
+    log = open('sofs.log.tsv').read()
+    if "replayed" in log or "not unmounted cleanly" in log:
+        raise Exception("The remount found a journal transaction to replay, or an FS that wasn't unmounted")
 
 tests = [Test('filename_test', filenameTest),Test('max_inodes_test', maxInodesTest),
-         Test('max_blocks_test', maxBlocksTest),Test('max_file_size_test', maxFileSizeTest)]    
+         Test('max_blocks_test', maxBlocksTest),Test('max_file_size_test', maxFileSizeTest),
+         Test('directories_test', directoriesTest),Test('inline_test', inlineTest),Test('statfs_test', statfsTest),
+         Test('remount_test', remountTest)]
 
 print "Choose your test"
 for i,test in enumerate(tests):